@@ -0,0 +1,76 @@
+"""Compare spawn latency of the Popen and posix_spawn backends.
+
+The daemon's heap is simulated by allocating and touching a buffer of the
+given size before spawning, since fork cost grows with the parent's memory.
+
+Usage: python bench/spawn_latency.py [-n 200] [--heap-mb 0 64 256 1024] [--json out.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from configuration import Program  # noqa: E402
+from monitor import Task  # noqa: E402
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def allocate_heap(size_mb: int) -> bytearray:
+    heap = bytearray(size_mb * 1024 * 1024)
+    # Touch every page, so it is really mapped and has to be copied on fork.
+    for i in range(0, len(heap), PAGE_SIZE):
+        heap[i] = 1
+    return heap
+
+
+def measure(backend: str, iterations: int) -> list:
+    program = Program(cmd="true")
+    latencies = []
+    for _ in range(iterations):
+        task = Task(program)
+        started = time.perf_counter()
+        task.start(backend)
+        latencies.append(time.perf_counter() - started)
+        task.process.wait()
+    return latencies
+
+
+def summarize(latencies: list) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spawn latency benchmark")
+    parser.add_argument("-n", "--iterations", type=int, default=200)
+    parser.add_argument("--heap-mb", type=int, nargs="+", default=[0, 64, 256, 1024])
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'Heap MB':>8} {'Backend':<12} {'Mean ms':>8} {'P50 ms':>8} {'P99 ms':>8}")
+    for size_mb in args.heap_mb:
+        heap = allocate_heap(size_mb)
+        for backend in ("popen", "posix_spawn"):
+            summary = summarize(measure(backend, args.iterations))
+            results.append({"heap_mb": size_mb, "backend": backend, **summary})
+            print(f"{size_mb:>8} {backend:<12} {summary['mean_ms']:>8.3f} "
+                  f"{summary['p50_ms']:>8.3f} {summary['p99_ms']:>8.3f}")
+        del heap
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"iterations": args.iterations, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
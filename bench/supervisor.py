@@ -0,0 +1,231 @@
+"""Measure how the daemon scales with the number of programs.
+
+For every size a daemon is started in the foreground with a generated
+configuration of that many `sleep` programs, plus an exit probe. Measured:
+start --all time and spawn throughput, exit detection latency, status
+round trip, reload time, stop --all time, daemon RSS and idle CPU.
+
+Exit detection latency is the time from the probe writing its exit
+timestamp until status reports it finished, polled every millisecond.
+
+The daemon runs with its default settings unless overridden with
+--setting name=value, the overrides are recorded with the JSON results.
+
+Usage: python bench/supervisor.py [--sizes 10 100 1000 10000] [--setting stats_interval=0] [--json out.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from client import Session  # noqa: E402
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+# Writes its exit time and exits right away, a Python probe would add its interpreter shutdown
+PROBE = "sleep 0.05\ndate +%s.%N > \"$1\"\n"
+LOG_CONFIG = """[loggers]
+keys=root
+
+[handlers]
+keys=null
+
+[formatters]
+keys=
+
+[logger_root]
+level=CRITICAL
+handlers=null
+
+[handler_null]
+class=NullHandler
+args=()
+"""
+
+
+def write_config(path: str, size: int, probe: str, stamp: str, settings: dict):
+    lines = []
+    if settings:
+        lines += ["settings:"] + [f"  {name}: {value}" for name, value in settings.items()]
+    lines.append("programs:")
+    for i in range(size):
+        lines += [f"  sleep_{i}:", "    cmd: sleep 3600", "    stopwaitsecs: 5"]
+    lines += ["  exit_probe:", f"    cmd: sh {probe} {stamp}"]
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def serve(config: str, sock: str, log_config: str):
+    """Run the daemon in the foreground, used as the benchmark's child process."""
+    import asyncio
+    from server import Server
+    server = Server(config, sock, log_config, sock + ".pid")
+    server.startup()
+    asyncio.run(server.serve_forever())
+
+
+def start_daemon(workdir: str, config: str):
+    sock = os.path.join(workdir, "taskmaster.sock")
+    log_config = os.path.join(workdir, "logging.conf")
+    with open(log_config, "w") as f:
+        f.write(LOG_CONFIG)
+    started = time.perf_counter()
+    daemon = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", config, sock, log_config],
+                              stdout=subprocess.DEVNULL)
+    while not os.path.exists(sock):
+        if daemon.poll() is not None:
+            raise RuntimeError(f"Daemon exited with {daemon.returncode}")
+        time.sleep(0.005)
+    return daemon, sock, time.perf_counter() - started
+
+
+def request(session: Session, cmd: str) -> dict:
+    for frame in session.request(cmd):
+        pass
+    if frame.get("status") != 0:
+        raise RuntimeError(f"{cmd}: {frame.get('msg')}")
+    return frame
+
+
+def timed(session: Session, cmd: str) -> float:
+    started = time.perf_counter()
+    request(session, cmd)
+    return time.perf_counter() - started
+
+
+def cpu_ticks(pid: int) -> int:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return int(fields[11]) + int(fields[12])
+
+
+def rss_kb(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def exit_latency(session: Session, stamp: str) -> float:
+    if os.path.exists(stamp):
+        os.remove(stamp)
+    # restart also starts a finished task again.
+    request(session, "restart exit_probe")
+    while True:
+        status = request(session, "status exit_probe")["msg"]
+        if "SUCCEEDED" in status or "FAILED" in status:
+            detected = time.time()
+            break
+        time.sleep(0.001)
+    with open(stamp) as f:
+        exited = float(f.read())
+    return detected - exited
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def bench(size: int, args) -> dict:
+    with tempfile.TemporaryDirectory(prefix="tm-bench-") as workdir:
+        config = os.path.join(workdir, "taskmaster.yaml")
+        probe = os.path.join(workdir, "probe.sh")
+        stamp = os.path.join(workdir, "probe.stamp")
+        with open(probe, "w") as f:
+            f.write(PROBE)
+        write_config(config, size, probe, stamp, args.settings)
+        daemon, sock, startup = start_daemon(workdir, config)
+        session = Session(sock)
+        try:
+            result = {"programs": size, "startup_s": startup}
+            result["start_all_s"] = timed(session, "start --all")
+            result["spawn_per_s"] = (size + 1) / result["start_all_s"]
+            time.sleep(0.2)
+            latencies = [exit_latency(session, stamp) for _ in range(args.probes)]
+            result["exit_latency_ms_p50"] = statistics.median(latencies) * 1000
+            result["exit_latency_ms_max"] = max(latencies) * 1000
+            rtts = [timed(session, "status sleep_0") for _ in range(args.rounds)]
+            result["status_rtt_ms_p50"] = statistics.median(rtts) * 1000
+            result["status_rtt_ms_p99"] = percentile(rtts, 0.99) * 1000
+            result["status_all_ms"] = timed(session, "status") * 1000
+            # Touch the file without changing a program, then change one program.
+            with open(config, "a") as f:
+                f.write("# touched\n")
+            result["reload_unchanged_ms"] = timed(session, "reload") * 1000
+            with open(config, "a") as f:
+                f.write("  changed:\n    cmd: sleep 3600\n")
+            result["reload_one_added_ms"] = timed(session, "reload") * 1000
+            result["rss_kb"] = rss_kb(daemon.pid)
+            ticks = cpu_ticks(daemon.pid)
+            time.sleep(args.idle_seconds)
+            result["idle_cpu_percent"] = (cpu_ticks(daemon.pid) - ticks) / CLK_TCK / args.idle_seconds * 100
+            result["stop_all_s"] = timed(session, "stop --all")
+            request(session, "stop_server")
+        finally:
+            session.close()
+            try:
+                daemon.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                daemon.kill()
+                daemon.wait()
+    return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def setting(value: str) -> tuple:
+    name, sep, value = value.partition("=")
+    if not sep or not name:
+        raise argparse.ArgumentTypeError(f"Expected name=value, not {value}")
+    return name, value
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == "--serve":
+        return serve(*sys.argv[2:])
+    parser = argparse.ArgumentParser(description="Supervisor scaling benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--rounds", type=int, default=50, help="Status round trips per size")
+    parser.add_argument("--probes", type=int, default=5, help="Exit latency probes per size")
+    parser.add_argument("--idle-seconds", type=float, default=2)
+    parser.add_argument("--setting", type=setting, action="append", default=[], dest="settings",
+                        help="Daemon setting name=value instead of its default, may be repeated")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+    args.settings = dict(args.settings)
+
+    columns = (("programs", "Programs", "d"), ("start_all_s", "Start s", ".3f"),
+               ("spawn_per_s", "Spawn/s", ".0f"), ("exit_latency_ms_p50", "Exit ms", ".2f"),
+               ("status_rtt_ms_p50", "RTT ms", ".2f"), ("reload_one_added_ms", "Reload ms", ".1f"),
+               ("rss_kb", "RSS KB", "d"), ("idle_cpu_percent", "Idle CPU%", ".1f"))
+    print(" ".join(f"{title:>10}" for _, title, _ in columns))
+    results = []
+    for size in args.sizes:
+        result = bench(size, args)
+        results.append(result)
+        print(" ".join(f"{result[key]:>10{fmt}}" for key, _, fmt in columns))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"revision": git_revision(), "python": platform.python_version(),
+                       "cpus": os.cpu_count(), "time": time.time(), "settings": args.settings,
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import contextlib
+import glob
+import logging
+import os
+
+NODE_PATH = "/sys/devices/system/node"
+POLICIES = ("spread", "pack")
+
+logger = logging.getLogger("Monitor")
+
+
+def parse_cpulist(cpulist: str) -> list:
+    """Parse a kernel cpu list like "0-3,8,10-11"."""
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def cpu_topology(node_path: str = NODE_PATH) -> list:
+    """CPUs the daemon may use, grouped by NUMA node. One group if there is no NUMA information."""
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    for path in sorted(glob.glob(os.path.join(node_path, "node[0-9]*", "cpulist")),
+                       key=lambda p: int(os.path.basename(os.path.dirname(p))[4:])):
+        try:
+            with open(path) as f:
+                cpus = [cpu for cpu in parse_cpulist(f.read()) if cpu in allowed]
+        except (OSError, ValueError):
+            continue
+        if cpus:
+            nodes.append(cpus)
+    covered = {cpu for node in nodes for cpu in node}
+    if covered != allowed:
+        # Missing or partial topology, treat it as a single node.
+        nodes = [sorted(allowed)]
+    return nodes
+
+
+def instance_cpus(policy, index: int, topology: list):
+    """CPUs of the index-th instance of a program under the placement policy.
+
+    "pack" fills the CPUs in node order, so neighbouring instances share a
+    node and its caches. "spread" takes turns between the nodes. A list of
+    CPUs is assigned round-robin. Returns None if there is no policy.
+    """
+    if policy is None:
+        return None
+    if policy == "pack":
+        cpus = [cpu for node in topology for cpu in node]
+        return {cpus[index % len(cpus)]}
+    if policy == "spread":
+        node = topology[index % len(topology)]
+        return {node[(index // len(topology)) % len(node)]}
+    return {policy[index % len(policy)]}
+
+
+@contextlib.contextmanager
+def inherited_affinity(cpus: set):
+    """Pin the calling thread to the cpus meanwhile, so processes it starts run on them from the start.
+
+    The previous affinity of the thread is restored afterwards. Failing to
+    pin isn't fatal, the processes then run on any cpu.
+    """
+    if not cpus:
+        yield
+        return
+    previous = os.sched_getaffinity(0)
+    try:
+        os.sched_setaffinity(0, cpus)
+    except OSError as e:
+        logger.warning(f"Failed to set cpu affinity {sorted(cpus)}: {e}")
+        yield
+        return
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
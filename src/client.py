@@ -0,0 +1,156 @@
+import itertools
+import select
+import socket
+from collections import defaultdict, deque
+
+from protocol import ProtocolError, recv_frame, send_frame
+
+
+class SocketError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(f"Socket error: {self.message}")
+
+
+class RequestError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+class Session:
+    """Long-lived connection to the daemon.
+
+    Requests carry an id, so several of them can be sent before reading
+    the responses. Frames without an id are events pushed by the daemon,
+    they are passed to on_event as soon as they are read.
+    """
+
+    def __init__(self, sock_file: str, on_event=None, on_connect=None):
+        self.sock_file = sock_file
+        self.on_event = on_event
+        self.on_connect = on_connect
+        self.sock = None
+        self._ids = itertools.count(1)
+        self._pending = defaultdict(deque)
+
+    def connect(self):
+        if self.sock is not None:
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.sock_file)
+        except OSError as e:
+            sock.close()
+            raise SocketError(e)
+        self.sock = sock
+        self._pending.clear()
+        if self.on_connect:
+            self.on_connect(self)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, cmd: str, **params) -> int:
+        """Send a request without waiting for the response. Returns the request id.
+
+        params are extra request keys, e.g. the filters of a service call.
+        """
+        request_id = next(self._ids)
+        for attempt in range(2):
+            self.connect()
+            try:
+                send_frame(self.sock, {"id": request_id, "cmd": cmd, **params})
+                return request_id
+            except OSError as e:
+                # The daemon may have closed an idle connection, reconnect once.
+                self.close()
+                if attempt:
+                    raise SocketError(e)
+
+    def responses(self, request_id: int):
+        """Yield response frames of the request until the last one."""
+        while True:
+            queue = self._pending.get(request_id)
+            frame = queue.popleft() if queue else self._read_frame(request_id)
+            if frame is None:
+                continue
+            if not frame.get("more"):
+                self._pending.pop(request_id, None)
+                yield frame
+                return
+            yield frame
+
+    def request(self, cmd: str, **params):
+        """Send the request and yield its response frames."""
+        return self.responses(self.send(cmd, **params))
+
+    def cancel(self, request_id: int):
+        """Ask the daemon to end a streamed response, e.g. of tail --follow."""
+        if self.sock is None:
+            return
+        try:
+            send_frame(self.sock, {"cancel": request_id})
+        except OSError as e:
+            raise SocketError(e)
+
+    def iter_status(self, page_size: int = None, **filters):
+        """Yield the status records of all matching tasks, fetched page by page.
+
+        filters are the tasks, groups, states and fields lists of _service_get_status.
+        """
+        params = {key: value for key, value in filters.items() if value is not None}
+        if page_size is not None:
+            params["limit"] = page_size
+        cursor = None
+        while True:
+            for frame in self.request("_service_get_status", **params, cursor=cursor):
+                pass
+            if frame.get("status"):
+                raise RequestError(frame.get("msg"))
+            yield from frame["tasks"]
+            cursor = frame["cursor"]
+            if cursor is None:
+                return
+
+    def pipeline(self, cmds):
+        """Send all commands at once, then collect the last frame of every response."""
+        request_ids = [self.send(cmd) for cmd in cmds]
+        results = []
+        for request_id in request_ids:
+            for frame in self.responses(request_id):
+                pass
+            results.append(frame)
+        return results
+
+    def poll_events(self):
+        """Dispatch events which were pushed while the session was idle."""
+        while self.sock is not None:
+            try:
+                readable, _, _ = select.select([self.sock], [], [], 0)
+            except (OSError, ValueError):
+                return
+            if not readable:
+                return
+            self._read_frame(None)
+
+    def _read_frame(self, request_id):
+        """Read one frame. Returns it if it belongs to request_id, queues it otherwise."""
+        if self.sock is None:
+            raise SocketError("Not connected")
+        try:
+            frame = recv_frame(self.sock)
+        except (OSError, ProtocolError) as e:
+            self.close()
+            raise SocketError(e)
+        frame_id = frame.get("id")
+        if frame_id is None and "event" in frame:
+            if self.on_event:
+                self.on_event(frame)
+            return None
+        if frame_id == request_id:
+            return frame
+        self._pending[frame_id].append(frame)
+        return None
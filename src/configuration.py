@@ -1,3 +1,5 @@
+import hashlib
+import json
 import logging.config
 import os.path
 import signal
@@ -5,6 +7,12 @@ from dataclasses import dataclass, field
 
 import yaml
 
+from limits import LimitError, parse_rlimits
+from probes import ProbeError, parse_healthcheck, parse_ready
+
+# LibYAML based loader is much faster on large configurations
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
 class ConfigurationError(Exception):
     def __init__(self, message):
@@ -20,6 +28,11 @@ class Program:
     exitcodes: list = field(default_factory=lambda: [0])
     startsecs: int = 0
     startretries: int = 3
+    # Automatic restarts wait backoff_base * 2 ** (restarts - 1) seconds, at most backoff_max,
+    # randomized by +-backoff_jitter of the delay
+    backoff_base: float = 1
+    backoff_max: float = 60
+    backoff_jitter: float = 0.2
     stopsignal: int = signal.SIGTERM
     stopwaitsecs: int = 10
     stdout: str = None
@@ -27,6 +40,29 @@ class Program:
     env: dict = None
     cwd: str = None
     umask: int = -1
+    priority: int = 999
+    # Route output through the daemon, which rotates the log files and keeps recent output in memory
+    capture: bool = False
+    capture_buffer: int = 64 * 1024
+    logfile_maxbytes: int = 50 * 1024 * 1024  # 0 means no rotation
+    logfile_backups: int = 3
+    # Resource limits like {"nofile": 1024, "as": [soft, hard]}, converted to {RLIMIT_*: (soft, hard)}
+    rlimits: dict = None
+    # cgroup v2 limits of all instances together, used if the cgroup_root setting is set
+    cpu_max: str = None
+    memory_max: str = None
+    # Pin every instance to a CPU: "spread" over NUMA nodes, "pack" node by node, or round-robin over a list
+    cpu_affinity: str | list = None
+    # Program sections which must be ready before this one is autostarted
+    depends_on: list = None
+    # When the program counts as ready for its dependents, instead of RUNNING after startsecs:
+    # {"socket": path or host:port} is accepting connections or {"file": path} exists.
+    # Converted to (kind, target).
+    ready: dict = None
+    # Probe of a RUNNING process, restarted after retries failures in a row:
+    # {"exec" | "tcp" | "unix" | "http": target, "interval": 10, "timeout": 2, "retries": 3}.
+    # Converted to a probes.HealthCheck.
+    healthcheck: dict = None
 
     @property
     def args(self):
@@ -45,10 +81,52 @@ class Program:
             raise ConfigurationError("startsecs must be greater than or equal to 0")
         if self.startretries < 0:
             raise ConfigurationError("startretries must be greater than or equal to 0")
+        for option in ("backoff_base", "backoff_max"):
+            value = getattr(self, option)
+            if not isinstance(value, (int, float)) or value < 0:
+                raise ConfigurationError(f"{option} must be a number greater than or equal to 0")
+        if not isinstance(self.backoff_jitter, (int, float)) or not 0 <= self.backoff_jitter <= 1:
+            raise ConfigurationError("backoff_jitter must be a number from 0 to 1")
         if self.stopsignal < 0:
             raise ConfigurationError("stopsignal must be greater than or equal to 0")
         if self.stopwaitsecs < 0:
             raise ConfigurationError("stopwaitsecs must be greater than or equal to 0")
+        if self.priority < 0:
+            raise ConfigurationError("priority must be greater than or equal to 0")
+        for option in ("capture_buffer", "logfile_maxbytes", "logfile_backups"):
+            value = getattr(self, option)
+            if not isinstance(value, int) or value < 0:
+                raise ConfigurationError(f"{option} must be an integer greater than or equal to 0")
+        if self.rlimits is not None:
+            if not isinstance(self.rlimits, dict):
+                raise ConfigurationError("rlimits must be a mapping of limit names to values")
+            try:
+                self.rlimits = parse_rlimits(self.rlimits)
+            except LimitError as e:
+                raise ConfigurationError(e.message)
+        for option in ("cpu_max", "memory_max"):
+            value = getattr(self, option)
+            if value is not None and not isinstance(value, (int, str)):
+                raise ConfigurationError(f"{option} must be a cgroup value like 'max' or a number")
+        if self.cpu_affinity is not None and self.cpu_affinity not in ("spread", "pack"):
+            if (not isinstance(self.cpu_affinity, list) or not self.cpu_affinity
+                    or not all(isinstance(cpu, int) and cpu >= 0 for cpu in self.cpu_affinity)):
+                raise ConfigurationError("cpu_affinity must be spread, pack or a list of CPU numbers")
+        if isinstance(self.depends_on, str):
+            self.depends_on = [self.depends_on]
+        if self.depends_on is not None:
+            if not isinstance(self.depends_on, list) or not all(isinstance(n, str) for n in self.depends_on):
+                raise ConfigurationError("depends_on must be a list of program names")
+        if self.ready is not None:
+            try:
+                self.ready = parse_ready(self.ready)
+            except ProbeError as e:
+                raise ConfigurationError(e.message)
+        if self.healthcheck is not None:
+            try:
+                self.healthcheck = parse_healthcheck(self.healthcheck)
+            except ProbeError as e:
+                raise ConfigurationError(e.message)
         if self.umask != -1:
             try:
                 self.umask = int(str(self.umask), 8)  # Convert to INT from octal int (?)
@@ -62,12 +140,61 @@ class Program:
             )
 
 
+@dataclass
+class Settings:
+    """Daemon wide settings from the optional settings section."""
+    spawn_concurrency: int = 8
+    spawn_rate: float = 0  # Processes spawned per second, 0 means unlimited
+    spawn_backend: str = "popen"
+    # Seconds between resource usage samples, taken only while status requests want them. 0 disables them.
+    stats_interval: float = 2
+    cgroup_root: str = None  # cgroup v2 directory for the program cgroups, e.g. /sys/fs/cgroup/taskmaster
+    # OpenMetrics endpoints, read at startup: a unix socket and/or a port on 127.0.0.1
+    metrics_socket: str = None
+    metrics_port: int = 0
+    slow_tick: float = 0.1  # Supervisor updates taking at least this many seconds are logged, 0 disables it
+    # State journal, read at startup to adopt the processes left running by the previous daemon
+    journal: str = None
+    health_concurrency: int = 16  # Health check probes running at the same time
+
+    def __post_init__(self):
+        if self.spawn_backend not in ("popen", "posix_spawn"):
+            raise ConfigurationError(f"Invalid spawn_backend value: {self.spawn_backend}")
+        if not isinstance(self.spawn_concurrency, int) or self.spawn_concurrency < 1:
+            raise ConfigurationError("spawn_concurrency must be an integer greater than 0")
+        if not isinstance(self.spawn_rate, (int, float)) or self.spawn_rate < 0:
+            raise ConfigurationError("spawn_rate must be a number greater than or equal to 0")
+        if not isinstance(self.stats_interval, (int, float)) or self.stats_interval < 0:
+            raise ConfigurationError("stats_interval must be a number greater than or equal to 0")
+        if self.cgroup_root is not None and not isinstance(self.cgroup_root, str):
+            raise ConfigurationError("cgroup_root must be a path")
+        if self.metrics_socket is not None and not isinstance(self.metrics_socket, str):
+            raise ConfigurationError("metrics_socket must be a path")
+        if not isinstance(self.metrics_port, int) or not 0 <= self.metrics_port <= 65535:
+            raise ConfigurationError("metrics_port must be a port number or 0")
+        if not isinstance(self.slow_tick, (int, float)) or self.slow_tick < 0:
+            raise ConfigurationError("slow_tick must be a number greater than or equal to 0")
+        if self.journal is not None and not isinstance(self.journal, str):
+            raise ConfigurationError("journal must be a path")
+        if not isinstance(self.health_concurrency, int) or self.health_concurrency < 1:
+            raise ConfigurationError("health_concurrency must be an integer greater than 0")
+
+
 class Configuration:
     program_section = "programs"
+    settings_section = "settings"
 
     def __init__(self, config_path: str):
         self.config_path = config_path
         self.logger = logging.getLogger("Configuration")
+        # Digest of the whole file and (digest, Program) of every program section
+        # from the last successful parse, used to skip unchanged parts on reload.
+        self.digest = None
+        self.sections = {}
+        self.programs = {}
+        # Program section name -> names of its numprocs instances
+        self.groups = {}
+        self.settings = Settings()
         self.programs = self.from_yaml()
 
     def reload_config(self):
@@ -75,19 +202,44 @@ class Configuration:
         self.programs = self.from_yaml()
         self.logger.info("Configuration reloaded.")
 
+    @staticmethod
+    def content_digest(content) -> str:
+        if not isinstance(content, bytes):
+            content = json.dumps(content, sort_keys=True, default=str).encode()
+        return hashlib.blake2b(content, digest_size=16).hexdigest()
+
     def from_yaml(self):
-        with open(self.config_path, "r") as f:
-            data = yaml.safe_load(f)
+        """Parse the configuration file into programs.
+
+        Program sections whose content didn't change since the last parse keep
+        their Program objects, so unchanged programs compare identical.
+        numprocs is not part of the section digest: changing it only adds or
+        removes instances.
+        """
+        with open(self.config_path, "rb") as f:
+            content = f.read()
+        digest = self.content_digest(content)
+        if digest == self.digest:
+            self.logger.info("Configuration file has not changed.")
+            return self.programs
+        data = yaml.load(content, Loader=SafeLoader) or {}
         program_configs = data.get(self.program_section)
 
         if not program_configs:
             raise ConfigurationError("No programs section in the configuration.")
+        settings = self.settings_from_dict(data.get(self.settings_section) or {})
         programs = {}
+        sections = {}
+        groups = {}
         for name, attributes in program_configs.items():
             try:
-                if name in programs:
-                    raise ConfigurationError(f"Duplicate program name: {name}")
                 num_procs = attributes.pop("numprocs", None)
+                section_digest = self.content_digest(attributes)
+                cached = self.sections.get(name)
+                if cached and cached[0] == section_digest:
+                    program = cached[1]
+                else:
+                    program = Program(**attributes)
                 if num_procs:
                     if not isinstance(num_procs, int):
                         raise ConfigurationError(
@@ -96,12 +248,18 @@ class Configuration:
                     if num_procs < 1:
                         raise ConfigurationError("numprocs must be greater than 0")
                     if num_procs == 1:
-                        programs[name] = Program(**attributes)
+                        instances = [name]
                     else:
-                        for i in range(num_procs):
-                            programs[f"{name}_{i + 1}"] = Program(**attributes)
+                        instances = [f"{name}_{i + 1}" for i in range(num_procs)]
                 else:
-                    programs[name] = Program(**attributes)
+                    instances = [name]
+                for instance in instances:
+                    if instance in programs:
+                        raise ConfigurationError(f"Duplicate program name: {instance}")
+                for instance in instances:
+                    programs[instance] = program
+                groups[name] = instances
+                sections[name] = (section_digest, program)
             except TypeError as e:
                 if "unexpected keyword argument" in str(e):
                     argument = str(e).split(" ")[-1]
@@ -116,4 +274,45 @@ class Configuration:
             except Exception as e:
                 self.logger.error(f"Undefined error parsing program {name} - {e}")
 
+        self.check_dependencies(sections)
+        # A rejected section may be valid next time, e.g. once its cwd exists, so the file is parsed again.
+        self.digest = digest if len(sections) == len(program_configs) else None
+        self.sections = sections
+        self.groups = groups
+        self.settings = settings
         return programs
+
+    @staticmethod
+    def check_dependencies(sections: dict):
+        """Raise a ConfigurationError for unknown program sections in depends_on and dependency cycles."""
+        depends_on = {name: program.depends_on or [] for name, (_, program) in sections.items()}
+        for name, dependencies in depends_on.items():
+            for dependency in dependencies:
+                if dependency not in depends_on:
+                    raise ConfigurationError(f"Program '{name}' depends on unknown program '{dependency}'")
+        # Iterative depth-first search, a dependency on the current path closes a cycle.
+        done = set()
+        for root in depends_on:
+            if root in done:
+                continue
+            path, on_path = [root], {root}
+            stack = [iter(depends_on[root])]
+            while stack:
+                dependency = next(stack[-1], None)
+                if dependency is None:
+                    on_path.discard(path[-1])
+                    done.add(path.pop())
+                    stack.pop()
+                elif dependency in on_path:
+                    cycle = path[path.index(dependency):] + [dependency]
+                    raise ConfigurationError(f"Dependency cycle: {' -> '.join(cycle)}")
+                elif dependency not in done:
+                    path.append(dependency)
+                    on_path.add(dependency)
+                    stack.append(iter(depends_on[dependency]))
+
+    def settings_from_dict(self, attributes: dict) -> Settings:
+        try:
+            return Settings(**attributes)
+        except TypeError as e:
+            raise ConfigurationError(f"Invalid {self.settings_section} section: {e}")
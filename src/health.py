@@ -0,0 +1,96 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+
+from probes import run_health_check
+
+# Probe intervals vary by +-HEALTH_JITTER of the interval, so probes of tasks started together drift apart
+HEALTH_JITTER = 0.1
+
+
+class HealthChecker:
+    """Run the health checks of running tasks with at most `concurrency` probes at once.
+
+    Due probes are kept in one heap. The first probe of a task is placed at
+    a random point of its first interval, so thousands of tasks started
+    together don't probe in bursts. Probes run as separate asyncio tasks,
+    a slow one only holds a slot of the shared semaphore.
+
+    is_current(name, task, pid) tells whether the task still runs the probed
+    process, on_unhealthy(name, task) is called once retries consecutive
+    probes failed. The task isn't probed again until it is watched again.
+    """
+
+    def __init__(self, concurrency: int, is_current, on_unhealthy):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.concurrency = concurrency
+        self.is_current = is_current
+        self.on_unhealthy = on_unhealthy
+        self.due = []
+        self._seq = itertools.count()
+        # Consecutive failed probes by task
+        self.failures = {}
+        self.probes = set()
+        self._wakeup = asyncio.Event()
+        self.logger = logging.getLogger("Monitor")
+
+    def configure(self, concurrency: int):
+        if concurrency != self.concurrency:
+            # Probes in flight release the slots of the old semaphore.
+            self.semaphore = asyncio.Semaphore(concurrency)
+            self.concurrency = concurrency
+
+    def watch(self, name: str, task):
+        """Start probing the current process of the task."""
+        check = task.program.healthcheck
+        self.failures.pop(task, None)
+        self._push(time.time() + random.uniform(0, check.interval), name, task, task.process.pid)
+
+    def _push(self, when: float, name: str, task, pid: int):
+        if not self.due or when < self.due[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self.due, (when, next(self._seq), name, task, pid))
+
+    async def run(self):
+        try:
+            while True:
+                timeout = max(0.0, self.due[0][0] - time.time()) if self.due else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                now = time.time()
+                while self.due and self.due[0][0] <= now:
+                    _, _, name, task, pid = heapq.heappop(self.due)
+                    if not self.is_current(name, task, pid):
+                        self.failures.pop(task, None)
+                        continue
+                    probe = asyncio.get_running_loop().create_task(self._probe(name, task, pid))
+                    self.probes.add(probe)
+                    probe.add_done_callback(self.probes.discard)
+        finally:
+            for probe in self.probes:
+                probe.cancel()
+
+    async def _probe(self, name: str, task, pid: int):
+        check = task.program.healthcheck
+        async with self.semaphore:
+            healthy = await run_health_check(check)
+        if not self.is_current(name, task, pid):
+            self.failures.pop(task, None)
+            return
+        if healthy:
+            self.failures.pop(task, None)
+        else:
+            failures = self.failures[task] = self.failures.get(task, 0) + 1
+            self.logger.debug(f"Health check of '{name}' failed ({failures}/{check.retries}).")
+            if failures >= check.retries:
+                del self.failures[task]
+                self.on_unhealthy(name, task)
+                return
+        interval = check.interval * random.uniform(1 - HEALTH_JITTER, 1 + HEALTH_JITTER)
+        self._push(time.time() + interval, name, task, pid)
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import logging
+import os
+
+# Compact once the file holds this many times more records than there are tasks
+COMPACT_RATIO = 4
+COMPACT_MIN_RECORDS = 1000
+
+
+class Journal:
+    """Append-only log of the task states, so a new daemon can adopt running processes.
+
+    Every line is the latest JSON record of one task, {"name": ..., "removed": true}
+    forgets it. Records are written once per loop iteration in one batch, and
+    the file is rewritten with only the current records when it has grown
+    COMPACT_RATIO times larger than that.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records = {}
+        self.pending = {}
+        self.lines = 0
+        self.file = None
+        self._flush_handle = None
+        self.logger = logging.getLogger("Monitor")
+
+    def load(self) -> dict:
+        """Replay the journal into the current record of every task, and compact it."""
+        records = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        name = record["name"]
+                    except (ValueError, KeyError, TypeError):
+                        # A torn last line from a crash, or garbage.
+                        continue
+                    if record.get("removed"):
+                        records.pop(name, None)
+                    else:
+                        records[name] = record
+        except FileNotFoundError:
+            pass
+        self.records = records
+        self.compact()
+        return dict(records)
+
+    def get(self, name: str):
+        """The latest record of the task, including one not written yet."""
+        if name in self.pending:
+            return self.pending[name]
+        return self.records.get(name)
+
+    def record(self, name: str, record: dict = None):
+        """Queue the current record of the task, None if the task was removed."""
+        self.pending[name] = record
+        if self._flush_handle is None:
+            try:
+                self._flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+            except RuntimeError:
+                self.flush()
+
+    def flush(self):
+        self._flush_handle = None
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        lines = []
+        for name, record in pending.items():
+            if record is None:
+                self.records.pop(name, None)
+                lines.append(json.dumps({"name": name, "removed": True}))
+            else:
+                self.records[name] = record
+                lines.append(json.dumps(record))
+        try:
+            if self.file is None:
+                self.file = open(self.path, "a")
+            self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+        except OSError as e:
+            self.logger.error(f"Failed to write journal {self.path}: {e}")
+            return
+        self.lines += len(lines)
+        if self.lines > max(COMPACT_MIN_RECORDS, COMPACT_RATIO * len(self.records)):
+            self.compact()
+
+    def compact(self):
+        """Replace the journal with the current records."""
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                for record in self.records.values():
+                    f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self.logger.error(f"Failed to compact journal {self.path}: {e}")
+            return
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.lines = len(self.records)
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import resource
+
+# Program rlimits values may be one limit for both soft and hard, or [soft, hard]
+UNLIMITED = ("unlimited", "infinity", -1)
+# File descriptors the daemon keeps free of pidfds, for pipes, log files and clients.
+# At least FD_RESERVE, or FD_RESERVE_RATIO of the open files limit if that is more.
+FD_RESERVE = 256
+FD_RESERVE_RATIO = 0.25
+
+
+class LimitError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+def parse_rlimits(rlimits: dict) -> dict:
+    """Convert program rlimits like {"nofile": [1024, 4096]} to {RLIMIT_NOFILE: (1024, 4096)}."""
+    parsed = {}
+    for name, value in rlimits.items():
+        limit = getattr(resource, f"RLIMIT_{str(name).upper()}", None)
+        if limit is None:
+            raise LimitError(f"Unknown rlimit: {name}")
+        values = value if isinstance(value, list) else [value, value]
+        if len(values) != 2:
+            raise LimitError(f"rlimit {name} must be a limit or [soft, hard]")
+        values = [resource.RLIM_INFINITY if v in UNLIMITED else v for v in values]
+        for v in values:
+            if not isinstance(v, int) or (v < 0 and v != resource.RLIM_INFINITY):
+                raise LimitError(f"Invalid rlimit {name} value: {v}")
+        parsed[limit] = tuple(values)
+    return parsed
+
+
+def raise_nofile_limit() -> tuple:
+    """Raise the daemon's soft limit of open files to its hard limit.
+
+    Returns the previous (soft, hard) limits, which children are set back to.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (OSError, ValueError) as e:
+            logging.getLogger("Monitor").warning(f"Failed to raise the open files limit to {hard}: {e}")
+    return soft, hard
+
+
+def fd_budget():
+    """Number of file descriptors which may be used outside of the reserve, None if unlimited."""
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return max(0, soft - max(FD_RESERVE, int(soft * FD_RESERVE_RATIO)))
+
+
+def apply_rlimits(pid: int, rlimits: dict):
+    """Set the parsed rlimits of a started process."""
+    for limit, values in rlimits.items():
+        try:
+            resource.prlimit(pid, limit, values)
+        except (OSError, ValueError) as e:
+            raise LimitError(f"Failed to set rlimit {limit} of pid {pid}: {e}")
+
+
+class Cgroups:
+    """Place programs into cgroup v2 groups under a root directory.
+
+    Every program group gets its own cgroup `<root>/<group>` with the
+    program's cpu.max and memory.max. Pids are queued and written to
+    cgroup.procs once per loop iteration, so starting many instances
+    opens every cgroup.procs once.
+
+    A process is moved only after it was started, so it runs outside of
+    the cgroup's limits at first. Children it forks meanwhile stay outside.
+    """
+
+    CONTROLLERS = "+cpu +memory"
+
+    def __init__(self, root: str = None):
+        self.root = root
+        self.configured = {}
+        self.pending = {}
+        self._flush_handle = None
+        self.logger = logging.getLogger("Monitor")
+
+    def configure(self, root: str):
+        if root != self.root:
+            self.root = root
+            self.configured.clear()
+
+    @staticmethod
+    def wants_cgroup(program) -> bool:
+        return program.cpu_max is not None or program.memory_max is not None
+
+    def path(self, group: str) -> str:
+        return os.path.join(self.root, group)
+
+    def setup(self, group: str, program):
+        """Create the group's cgroup and write the program's limits if they changed."""
+        if self.configured.get(group) is program:
+            return
+        if not self.configured:
+            self._enable_controllers()
+        path = self.path(group)
+        os.makedirs(path, exist_ok=True)
+        for file, value in (("cpu.max", program.cpu_max), ("memory.max", program.memory_max)):
+            with open(os.path.join(path, file), "w") as f:
+                f.write(f"{'max' if value is None else value}\n")
+        self.configured[group] = program
+
+    def _enable_controllers(self):
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            with open(os.path.join(self.root, "cgroup.subtree_control"), "w") as f:
+                f.write(self.CONTROLLERS)
+        except OSError as e:
+            self.logger.warning(f"Failed to enable cgroup controllers in {self.root}: {e}")
+
+    def place(self, group: str, program, pid: int):
+        """Queue the pid to be moved into the group's cgroup."""
+        if self.root is None or not self.wants_cgroup(program):
+            return
+        try:
+            self.setup(group, program)
+        except OSError as e:
+            self.logger.error(f"Failed to set up cgroup {self.path(group)}: {e}")
+            return
+        self.pending.setdefault(group, []).append(pid)
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        """Write the queued pids, one open of cgroup.procs per cgroup."""
+        self._flush_handle = None
+        pending, self.pending = self.pending, {}
+        for group, pids in pending.items():
+            try:
+                fd = os.open(os.path.join(self.path(group), "cgroup.procs"), os.O_WRONLY | os.O_CREAT, 0o644)
+            except OSError as e:
+                self.logger.error(f"Failed to move {len(pids)} processes to cgroup {group}: {e}")
+                continue
+            try:
+                for pid in pids:
+                    try:
+                        # The kernel takes one pid per write.
+                        os.write(fd, b"%d\n" % pid)
+                    except OSError as e:
+                        # The process may have exited already.
+                        self.logger.debug(f"Failed to move pid {pid} to cgroup {group}: {e}")
+            finally:
+                os.close(fd)
@@ -0,0 +1,272 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import NamedTuple
+
+LOG_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+LOG_MODE = 0o666
+READ_SIZE = 64 * 1024
+# Reads of one pipe per readiness callback, so a noisy task can't starve the loop
+MAX_READS = 16
+# Pending log data is written out after this delay or when it grows past FLUSH_SIZE
+FLUSH_INTERVAL = 0.2
+FLUSH_SIZE = 256 * 1024
+# Output sent by tail before following new output
+TAIL_SIZE = 16 * 1024
+# How often a followed log file, which the daemon doesn't write itself, is checked for growth
+FOLLOW_INTERVAL = 0.5
+
+
+class RingBuffer:
+    """Keep the last `size` bytes of a stream in memory.
+
+    `total` counts every byte ever appended, so readers can remember an
+    offset and later ask for what was written after it.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.chunks = deque()
+        self.length = 0
+        self.total = 0
+        self.waiters = set()
+
+    def append(self, data: bytes):
+        self.total += len(data)
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+        if not self.size:
+            return
+        self.chunks.append(data)
+        self.length += len(data)
+        while self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+
+    def read(self, offset: int = 0) -> tuple:
+        """Return (data written after offset that is still buffered, current total)."""
+        data = b"".join(self.chunks)[-self.size:]
+        start = self.total - len(data)
+        if offset > start:
+            data = data[offset - start:]
+        return data, self.total
+
+    async def wait(self, offset: int):
+        """Wait until there is output after offset."""
+        if self.total > offset:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.add(waiter)
+        try:
+            await waiter
+        finally:
+            self.waiters.discard(waiter)
+
+
+class FileSegment(NamedTuple):
+    """Part of a file to be sent as it is, e.g. with sendfile."""
+    path: str
+    offset: int
+    count: int
+
+
+async def tail_buffer(buffer: RingBuffer, size: int = TAIL_SIZE, follow: bool = False):
+    """Yield the last size bytes of the buffer, then new output if follow is set."""
+    data, offset = buffer.read(max(0, buffer.total - size))
+    if data:
+        yield data
+    while follow:
+        await buffer.wait(offset)
+        data, offset = buffer.read(offset)
+        if data:
+            yield data
+
+
+async def tail_file(path: str, size: int = TAIL_SIZE, follow: bool = False):
+    """Yield FileSegments of the last size bytes of the file, then of what is appended to it."""
+    offset = None
+    while True:
+        try:
+            end = os.path.getsize(path)
+        except OSError:
+            end = 0
+        if offset is None:
+            offset = max(0, end - size)
+        elif end < offset:
+            # Truncated or rotated, start over with the new file.
+            offset = 0
+        if end > offset:
+            yield FileSegment(path, offset, end - offset)
+            offset = end
+        if not follow:
+            return
+        await asyncio.sleep(FOLLOW_INTERVAL)
+
+
+class RotatingLog:
+    """Append-only log file rotated by size, written in batches."""
+
+    def __init__(self, path: str, maxbytes: int = 0, backups: int = 0):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.backups = backups
+        self.fd = os.open(path, LOG_FLAGS, LOG_MODE)
+        self.size = os.fstat(self.fd).st_size
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, data: bytes):
+        self.pending.append(data)
+        self.pending_size += len(data)
+
+    def flush(self):
+        data = memoryview(b"".join(self.pending))
+        self.pending.clear()
+        self.pending_size = 0
+        while data:
+            if self.maxbytes and self.size >= self.maxbytes:
+                self.rotate()
+            room = self.maxbytes - self.size if self.maxbytes else len(data)
+            written = os.write(self.fd, data[:room])
+            self.size += written
+            data = data[written:]
+
+    def rotate(self):
+        os.close(self.fd)
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+            self.fd = os.open(self.path, LOG_FLAGS, LOG_MODE)
+        else:
+            self.fd = os.open(self.path, LOG_FLAGS | os.O_TRUNC, LOG_MODE)
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+
+class LogCapture:
+    """Drain child stdout/stderr pipes on the event loop.
+
+    Output of every task goes into a ring buffer per stream and, if the
+    program has a stdout/stderr path, into a size-rotated log file shared
+    by all writers of that path.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.logs = {}
+        self.pipes = {}
+        self._flush_handle = None
+        self.logger = logging.getLogger("Monitor")
+
+    def attach(self, name: str, program, pipes: dict):
+        """Start draining the pipes of a freshly started task."""
+        loop = asyncio.get_running_loop()
+        for stream, fd in pipes.items():
+            buffer = self.buffer(name, stream, program.capture_buffer)
+            path = getattr(program, stream)
+            log = None
+            if path:
+                try:
+                    log = self._open_log(path, program)
+                except OSError as e:
+                    self.logger.error(f"Failed to open log file {path} of '{name}': {e}")
+            os.set_blocking(fd, False)
+            self.pipes[fd] = (buffer, log, name, stream)
+            loop.add_reader(fd, self._drain, fd)
+
+    def buffer(self, name: str, stream: str = "stdout", size: int = None):
+        """Ring buffer of the task's stream. It is created with size bytes if it doesn't exist."""
+        buffers = self.buffers.setdefault(name, {}) if size is not None else self.buffers.get(name, {})
+        if stream not in buffers and size is not None:
+            buffers[stream] = RingBuffer(size)
+        return buffers.get(stream)
+
+    def forget(self, name: str):
+        """Drop the ring buffers of a removed task. Open pipes are still drained."""
+        self.buffers.pop(name, None)
+
+    def _open_log(self, path: str, program) -> RotatingLog:
+        log = self.logs.get(path)
+        if log is None:
+            log = self.logs[path] = RotatingLog(path, program.logfile_maxbytes, program.logfile_backups)
+        else:
+            log.maxbytes = program.logfile_maxbytes
+            log.backups = program.logfile_backups
+        return log
+
+    def _drain(self, fd: int):
+        buffer, log, _, _ = self.pipes[fd]
+        for _ in range(MAX_READS):
+            try:
+                data = os.read(fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                self.logger.error(f"Failed to read task output: {e}")
+                data = b""
+            if not data:
+                self._close_pipe(fd)
+                break
+            buffer.append(data)
+            if log is not None:
+                log.write(data)
+                if log.pending_size >= FLUSH_SIZE:
+                    self._flush_log(log)
+        if log is not None and log.pending and self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(FLUSH_INTERVAL, self.flush)
+
+    def _close_pipe(self, fd: int):
+        asyncio.get_running_loop().remove_reader(fd)
+        os.close(fd)
+        log = self.pipes.pop(fd)[1]
+        if log is not None:
+            self._flush_log(log)
+
+    def _flush_log(self, log: RotatingLog):
+        try:
+            log.flush()
+        except OSError as e:
+            self.logger.error(f"Failed to write log file {log.path}: {e}")
+
+    def flush(self):
+        """Write out pending output of all log files."""
+        self._flush_handle = None
+        for log in self.logs.values():
+            if log.pending:
+                self._flush_log(log)
+
+    def detach(self) -> dict:
+        """Stop draining the pipes and leave them open and inheritable for a re-executed daemon.
+
+        Returns the pipe fds by task name and stream. Unread output stays in the pipes.
+        """
+        loop = asyncio.get_running_loop()
+        pipes = {}
+        for fd, (_, _, name, stream) in self.pipes.items():
+            loop.remove_reader(fd)
+            os.set_blocking(fd, True)
+            os.set_inheritable(fd, True)
+            pipes.setdefault(name, {})[stream] = fd
+        self.pipes.clear()
+        self.flush()
+        return pipes
+
+    def close(self):
+        loop = asyncio.get_running_loop()
+        for fd in list(self.pipes):
+            loop.remove_reader(fd)
+            os.close(fd)
+        self.pipes.clear()
+        for log in self.logs.values():
+            try:
+                log.close()
+            except OSError:
+                pass
+        self.logs.clear()
@@ -0,0 +1,173 @@
+import asyncio
+import bisect
+import logging
+import math
+import os
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+REQUEST_TIMEOUT = 5
+# Upper bounds in seconds of the default histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+class Metric:
+    """A metric family, one value per combination of label values."""
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def render(self):
+        yield f"# TYPE {self.name} {self.type}\n"
+        yield f"# HELP {self.name} {_escape(self.documentation)}\n"
+        for label_values, value in self.values.items():
+            yield from self.render_sample(label_values, value)
+
+    def render_sample(self, label_values: tuple, value):
+        yield f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}\n"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render_sample(self, label_values: tuple, value):
+        yield f"{self.name}_total{_format_labels(self.labels, label_values)} {_format_value(value)}\n"
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, *label_values, value: float):
+        self.values[label_values] = value
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(Metric):
+    """Histogram with fixed buckets. Values are [bucket counts..., sum, count]."""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values):
+        data = self.values.get(label_values)
+        if data is None:
+            data = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        # Counts are kept per bucket and made cumulative when rendered.
+        data[bisect.bisect_left(self.buckets, value)] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def render_sample(self, label_values: tuple, data):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), data):
+            cumulative += count
+            labels = _format_labels(self.labels, label_values, f'le="{_format_value(float(bound))}"')
+            yield f"{self.name}_bucket{labels} {cumulative}\n"
+        labels = _format_labels(self.labels, label_values)
+        yield f"{self.name}_sum{labels} {_format_value(data[-2])}\n"
+        yield f"{self.name}_count{labels} {data[-1]}\n"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self) -> str:
+        """The OpenMetrics text exposition of all metrics."""
+        parts = []
+        for metric in self.metrics.values():
+            parts.extend(metric.render())
+        parts.append("# EOF\n")
+        return "".join(parts)
+
+
+class MetricsServer:
+    """Serve the registry over HTTP on a unix socket and/or a localhost TCP port.
+
+    Any GET request gets the metrics, there is nothing else to serve.
+    """
+
+    def __init__(self, registry: Registry):
+        self.registry = registry
+        self.servers = []
+        self.logger = logging.getLogger("Server")
+
+    async def start(self, socket_path: str = None, port: int = 0):
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.servers.append(await asyncio.start_unix_server(self._serve, path=socket_path))
+            self.logger.info(f"Serving metrics on {socket_path}.")
+        if port:
+            self.servers.append(await asyncio.start_server(self._serve, host="127.0.0.1", port=port))
+            self.logger.info(f"Serving metrics on 127.0.0.1:{port}.")
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        self.servers.clear()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+            method = request.split(b" ", 1)[0]
+            if method in (b"GET", b"HEAD"):
+                body = self.registry.render().encode()
+                head = (f"HTTP/1.0 200 OK\r\nContent-Type: {CONTENT_TYPE}\r\n"
+                        f"Content-Length: {len(body)}\r\n\r\n").encode()
+                writer.write(head if method == b"HEAD" else head + body)
+            else:
+                writer.write(b"HTTP/1.0 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError) as e:
+            self.logger.debug(f"Metrics request failed: {e!r}")
+        finally:
+            writer.close()
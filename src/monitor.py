@@ -1,12 +1,49 @@
+import asyncio
+import bisect
+import enum
+import heapq
+import itertools
 import logging
+import random
 
+from affinity import cpu_topology, inherited_affinity, instance_cpus
 from configuration import Program, Configuration
+from health import HealthChecker
+from journal import Journal
+from logcapture import LogCapture, tail_buffer, tail_file
+from limits import Cgroups, LimitError, apply_rlimits, fd_budget, raise_nofile_limit
+from metrics import Registry
+from probes import check_ready
+from procstats import ProcSampler, read_starttime
+from spawner import AdoptedProcess, Spawner, can_posix_spawn, open_capture_pipes, posix_spawn_process
+import resource
+import selectors
 import subprocess
 import time
 import os
 
 UMASK = os.umask(0)
 os.umask(UMASK)
+# How often a watched status is refreshed while resource sampling is disabled
+SAMPLE_DISABLED_CHECK = 2
+# Resource usage is only sampled while it was requested within this many seconds
+STATS_IDLE_TIMEOUT = 60
+# How often a socket or file ready condition of a dependency is checked
+READY_CHECK_INTERVAL = 0.1
+# Fields of the status records, by name: value of (name, task, sampled ProcStats or None)
+STATUS_FIELDS = {
+    "name": lambda name, task, stats: name,
+    "group": lambda name, task, stats: task.group,
+    "state": lambda name, task, stats: task.status,
+    "pid": lambda name, task, stats: task.process.pid if task.is_busy() else None,
+    "exitcode": lambda name, task, stats: task.process.returncode if task.process else None,
+    "restarts": lambda name, task, stats: task.restart_count,
+    "start_time": lambda name, task, stats: task.start_time,
+    "cpu": lambda name, task, stats: stats and stats.cpu,
+    "rss": lambda name, task, stats: stats and stats.rss,
+    "fds": lambda name, task, stats: stats and stats.fds,
+    "threads": lambda name, task, stats: stats and stats.threads,
+}
 
 class TaskError(Exception):
     def __init__(self, message):
@@ -14,68 +51,166 @@ class TaskError(Exception):
         super().__init__(self.message)
 
 
+class State(enum.IntEnum):
+    CREATED = 0
+    STARTING = 1
+    RUNNING = 2
+    STOPPING = 3
+    SUCCEEDED = 4
+    FAILED = 5
+    STOPPED = 6
+    KILLED = 7
+    BACKOFF = 8  # Waiting for a delayed automatic restart
+    FATAL = 9  # Failed with no restarts left
+
+
 class Task:
+    __slots__ = ("program", "name", "group", "process", "start_time", "stop_time",
+                 "restart_count", "rebooting", "state", "listener", "pipes",
+                 "backoff_until", "index", "cpus", "state_since", "unhealthy")
 
-    DONE = ["SUCCEEDED", "FAILED", "KILLED", "STOPPED"]
-    BUSY = ["STARTING", "STOPPING", "RUNNING"]
+    DONE = frozenset((State.SUCCEEDED, State.FAILED, State.KILLED, State.STOPPED, State.FATAL))
+    BUSY = frozenset((State.STARTING, State.STOPPING, State.RUNNING))
+    logger = logging.getLogger("Task")
+    # Limits the daemon raised for itself, set back on every process unless its program sets them
+    restored_rlimits = {}
 
-    def __init__(self, program: Program):
+    def __init__(self, program: Program, name: str = None, group: str = None, index: int = 0):
         self.program = program
+        self.name = name
+        self.group = group or name
+        # Position among the numprocs instances of the program
+        self.index = index
+        # CPUs the process is pinned to, None to leave it to the kernel
+        self.cpus = None
         self.process = None
         self.start_time = None
         self.stop_time = None
         self.restart_count = 0
         self.rebooting = 0
-        self.status = "CREATED"
-        self.logger = logging.getLogger("Task")
+        self.state = State.CREATED
+        # Monotonic time of the last transition, kept by the monitor
+        self.state_since = time.monotonic()
+        # Called with (task, old_state, new_state) on every transition
+        self.listener = None
+        # Read ends of the output pipes of a captured process, until the monitor takes them
+        self.pipes = None
+        self.backoff_until = None
+        # Stopped because it failed its health check, it ends up FAILED
+        self.unhealthy = False
 
     def __repr__(self):
         return f"<Task '{self.program.cmd}' in status {self.status} with pid {self.process.pid if self.process else '?'}>"
 
-    def start(self):
+    @property
+    def status(self) -> str:
+        return self.state.name
+
+    def set_state(self, state: State):
+        old_state = self.state
+        if old_state is state:
+            return
+        self.state = state
+        if self.listener is not None:
+            self.listener(self, old_state, state)
+
+    def start(self, backend: str = "popen"):
         """Start the program. Status becomes STARTING."""
-        if self.process and self.process.poll() is None:
-            raise TaskError("Task has already started.")
+        self.started(*self.create_process(backend))
+
+    def started(self, process, pipes: dict = None):
+        """Take over the freshly created process. Status becomes STARTING."""
         self.rebooting = False
+        self.unhealthy = False
         self.start_time = time.time()
+        self.process = process
+        self.pipes = pipes
+        self.set_state(State.STARTING)
+
+    def create_process(self, backend: str = "popen"):
+        """Create the program's process without changing the task.
+
+        It is safe to call from a worker thread. backend "posix_spawn" avoids
+        forking a copy of a large daemon, Popen is still used for programs
+        which posix_spawn can't start.
+        Returns the process and the read ends of its output pipes if the
+        program's output is captured, None otherwise.
+        """
+        if self.process and self.process.poll() is None:
+            raise TaskError("Task has already started.")
         stdout, stderr = None, None
+        pipes, child_pipes = None, {}
         try:
-            stdout = open(self.program.stdout, "a") if self.program.stdout else None
-            stderr = open(self.program.stderr, "a") if self.program.stderr else None
-            self.process = subprocess.Popen(
-                    args=self.program.args,
-                    cwd=self.program.cwd,
-                    stdout=stdout,
-                    stderr=stderr,
-                    env=self.program.env,
-                    umask=self.program.umask,
-            )
-            self.status = "STARTING"
+            if self.program.capture:
+                pipes, child_pipes = open_capture_pipes()
+            # The child inherits the affinity of the spawning thread.
+            with inherited_affinity(self.cpus):
+                if backend == "posix_spawn" and can_posix_spawn(self.program):
+                    process = posix_spawn_process(self.program, child_pipes)
+                else:
+                    if child_pipes:
+                        stdout, stderr = child_pipes["stdout"], child_pipes["stderr"]
+                    else:
+                        stdout = open(self.program.stdout, "a") if self.program.stdout else None
+                        stderr = open(self.program.stderr, "a") if self.program.stderr else None
+                    process = subprocess.Popen(
+                            args=self.program.args,
+                            cwd=self.program.cwd,
+                            stdout=stdout,
+                            stderr=stderr,
+                            env=self.program.env,
+                            umask=self.program.umask,
+                    )
+            rlimits = {**self.restored_rlimits, **(self.program.rlimits or {})}
+            if rlimits:
+                self.limit_process(process, rlimits)
+            return process, pipes
         except Exception as e:
+            for fd in (pipes or {}).values():
+                os.close(fd)
             self.logger.error(
                 f"Failed to create subprocess '{self.program.cmd}' with error: {e}")
             raise TaskError(
                 f"Failed to create subprocess '{self.program.cmd}' with error: {e}")
         finally:
-            if stdout:
+            # The child has its own copies of the write ends now.
+            for fd in child_pipes.values():
+                os.close(fd)
+            if stdout and not child_pipes:
                 stdout.close()
-            if stderr:
+            if stderr and not child_pipes:
                 stderr.close()
 
+    def limit_process(self, process, rlimits: dict):
+        """Apply the rlimits to the new process, killing it if that fails.
+
+        prlimit is used on the started process because a preexec_fn isn't safe
+        in the threaded spawner and posix_spawn has no rlimit action. The
+        limits therefore only apply once the program runs: it may already
+        have allocated, opened files or forked by then, and its children
+        keep the limits they started with.
+        """
+        try:
+            apply_rlimits(process.pid, rlimits)
+        except LimitError:
+            process.kill()
+            process.wait()
+            raise
+
     def check_start(self):
         """Check if the program has started."""
         return_code = self.process.poll()
         if return_code is None:
-            if time.time() - self.start_time > self.program.startsecs:
+            if time.time() - self.start_time >= self.program.startsecs:
                 self.logger.info(f"Program '{self.program.cmd}' started successfully.")
-                self.status = "RUNNING"
+                self.set_state(State.RUNNING)
             return
         if return_code in self.program.exitcodes:
             self.logger.info(f"Program '{self.program.cmd}' exited with code {return_code}.")
-            self.status = "SUCCEEDED"
+            self.set_state(State.SUCCEEDED)
         else:
             self.logger.info(f"Program '{self.program.cmd}' failed to start.")
-            self.status = "FAILED"
+            self.set_state(State.FAILED)
 
     def stop(self):
         """Stop the program. Status becomes STOPPING."""
@@ -84,19 +219,27 @@ class Task:
                 raise TaskError("Task is not running.")
         else:
             raise TaskError("Task is not initialized.")
-        self.status = "STOPPING"
+        self.set_state(State.STOPPING)
         self.stop_time = time.time()
         self.process.send_signal(self.program.stopsignal)
 
+    def stop_unhealthy(self):
+        """Stop the program after it failed its health check.
+
+        Once stopped it is FAILED, and restarted like a program which exited unexpectedly.
+        """
+        self.stop()
+        self.unhealthy = True
+
     def check_stop(self):
         """Check if the program has stopped."""
         return_code = self.process.poll()
         if return_code is not None:
-            self.status = "STOPPED"
+            self.set_state(State.FAILED if self.unhealthy else State.STOPPED)
             self.process.wait()
             self.logger.info(f"Program '{self.program.cmd}' stopped.")
-        elif not self.program.stopwaitsecs or time.time() - self.stop_time > self.program.stopwaitsecs:
-            self.status = "KILLED"
+        elif time.time() - self.stop_time >= self.program.stopwaitsecs:
+            self.set_state(State.FAILED if self.unhealthy else State.KILLED)
             self.logger.info(f"Program '{self.program.cmd}' failed to stop, killing process.")
             self.process.kill()
             self.process.wait()
@@ -110,51 +253,95 @@ class Task:
         self.process.wait()
         if return_code in self.program.exitcodes:
             self.logger.info(f"Program '{self.program.cmd}' exited with code {return_code}.")
-            self.status = "SUCCEEDED"
+            self.set_state(State.SUCCEEDED)
         else:
             self.logger.info(f"Program '{self.program.cmd}' failed with exit code {return_code}.")
-            self.status = "FAILED"
+            self.set_state(State.FAILED)
 
     def restart(self):
-        """Restart the program. Status becomes RESTARTING."""
+        """Restart the program. Stops it first if it is running.
+
+        Returns False if the program isn't running and has to be started right away.
+        """
         self.logger.info(f"Restarting program '{self.program.cmd}'.")
         try:
             self.stop()
             self.rebooting = True
+            return True
         except TaskError:
-            self.start()
+            return False
 
     def check_done(self):
+        """Check if the finished program has to be started again.
+
+        Automatic restarts go through BACKOFF first, unless their delay is 0.
+        A failed program which ran out of restarts becomes FATAL. A program
+        stopped by its health check is restarted whatever its autorestart.
+        """
+        unhealthy, self.unhealthy = self.unhealthy, False
         if self.rebooting:
-            self.start()
-        elif self.status in ["SUCCEEDED", "FAILED"]:
+            return True
+        elif self.state in (State.SUCCEEDED, State.FAILED):
             prog = self.program
-            if ((prog.autorestart == "always" or
-                 (prog.autorestart == "unexpected" and self.status == "FAILED"))
-                    and self.restart_count < prog.startretries):
+            if (prog.autorestart == "always" or unhealthy or
+                    (prog.autorestart == "unexpected" and self.state is State.FAILED)):
+                if self.restart_count >= prog.startretries:
+                    if self.state is State.FAILED:
+                        self.logger.info(f"Program '{prog.cmd}' has no restarts left.")
+                        self.set_state(State.FATAL)
+                    return False
                 self.restart_count += 1
-                self.logger.info(f"Restarting program '{prog.cmd}', restart count {self.restart_count}/{prog.startretries}.")
-                self.start()
+                delay = self.backoff_delay()
+                self.logger.info(f"Restarting program '{prog.cmd}' in {delay:.2f}s, "
+                                 f"restart count {self.restart_count}/{prog.startretries}.")
+                if delay > 0:
+                    self.backoff_until = time.time() + delay
+                    self.set_state(State.BACKOFF)
+                    return False
+                return True
+        return False
+
+    def backoff_delay(self) -> float:
+        """Delay of the current automatic restart, exponential in the restart count."""
+        prog = self.program
+        delay = min(prog.backoff_max, prog.backoff_base * 2 ** (self.restart_count - 1))
+        return delay * random.uniform(1 - prog.backoff_jitter, 1 + prog.backoff_jitter)
 
     def update_status(self):
-        """Update the status of the program based on the status of its processes."""
-        if self.status == "STARTING":
+        """Update the status of the program based on the status of its processes.
+
+        Returns True if the program has to be started again.
+        """
+        if self.state is State.STARTING:
             self.check_start()
-        elif self.status == "STOPPING":
+        elif self.state is State.STOPPING:
             self.check_stop()
-        elif self.status == "RUNNING":
+        elif self.state is State.RUNNING:
             self.check_running()
+        elif self.state is State.BACKOFF:
+            return time.time() >= self.backoff_until
         if self.is_done():
-            self.check_done()
+            return self.check_done()
+        return False
+
+    def deadline(self):
+        """Time of the next timed transition, None if the task doesn't wait for one."""
+        if self.state is State.STARTING:
+            return self.start_time + self.program.startsecs
+        if self.state is State.STOPPING:
+            return self.stop_time + self.program.stopwaitsecs
+        if self.state is State.BACKOFF:
+            return self.backoff_until
+        return None
 
     def is_busy(self):
-        return self.status in self.BUSY
+        return self.state in self.BUSY
 
     def is_done(self):
-        return self.status in self.DONE
+        return self.state in self.DONE
 
     def is_idle(self):
-        return self.status == "CREATED"
+        return self.state is State.CREATED
 
     def get_rc(self):
         if self.process:
@@ -165,6 +352,80 @@ class Task:
         return "N/A"
 
 
+class ChildWatcher:
+    """Report exited children through pidfds instead of polling every task.
+
+    Each started process gets a pidfd registered in an epoll selector.
+    The selector fd itself becomes readable when any child exits,
+    so the server loop can wait on it alongside the control socket.
+    At most max_watched pidfds are open, so they can't use up the fds
+    the daemon needs otherwise. Processes beyond that are polled.
+    """
+
+    def __init__(self, max_watched: int = None):
+        self.enabled = hasattr(os, "pidfd_open") and hasattr(selectors, "EpollSelector")
+        self.selector = selectors.EpollSelector() if self.enabled else None
+        self.watched = set()
+        self.max_watched = max_watched
+        self.logger = logging.getLogger("Monitor")
+        if self.enabled:
+            try:
+                os.close(os.pidfd_open(os.getpid()))
+            except OSError as e:
+                # Kernel without pidfd support, fall back to polling.
+                self.logger.warning(f"pidfd is not supported ({e}), polling tasks instead.")
+                self.selector.close()
+                self.selector = None
+                self.enabled = False
+
+    def fileno(self):
+        return self.selector.fileno() if self.enabled else -1
+
+    def watch(self, name: str, task: Task):
+        """Watch the current process of the task. Returns False if it can't be watched."""
+        process = task.process
+        if not self.enabled or process is None:
+            return False
+        if process.pid in self.watched:
+            return True
+        if process.returncode is not None:
+            # Already reaped, the pid may belong to someone else by now.
+            return False
+        if self.max_watched is not None and len(self.watched) >= self.max_watched:
+            return False
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except OSError:
+            return False
+        self.selector.register(pidfd, selectors.EVENT_READ, (name, task, process.pid))
+        self.watched.add(process.pid)
+        return True
+
+    def exited(self):
+        """Return (name, task) pairs for processes which exited since the last call."""
+        if not self.enabled:
+            return []
+        exited = []
+        for key, _ in self.selector.select(0):
+            name, task, pid = key.data
+            self.selector.unregister(key.fd)
+            os.close(key.fd)
+            self.watched.discard(pid)
+            exited.append((name, task))
+        return exited
+
+    def close(self):
+        """Close the pidfds, processes started afterwards aren't watched."""
+        if not self.enabled:
+            return
+        for key in list(self.selector.get_map().values()):
+            os.close(key.fd)
+        self.selector.close()
+        self.selector = None
+        self.enabled = False
+        self.watched.clear()
+
+
 class MonitorError(Exception):
     def __init__(self, message):
         self.message = message
@@ -172,68 +433,329 @@ class MonitorError(Exception):
 
 
 class Monitor:
-    STATUS_FORMAT = "{:<20} {:<12} {:<8} {:<8} {:<6}\n"
-    STATUS_FORMAT_LEN = 57
-    STATUS_HEADER = STATUS_FORMAT.format('Name', 'Status', 'RC', 'Retries', 'Umask')
+    STATUS_FORMAT = "{:<20} {:<12} {:<8} {:<8} {:<6} {:>6} {:>7} {:>5} {:>7}\n"
+    STATUS_FORMAT_LEN = 88
+    STATUS_HEADER = STATUS_FORMAT.format('Name', 'Status', 'RC', 'Retries', 'Umask',
+                                         'CPU%', 'RSS', 'FDs', 'Threads')
 
     def __init__(self, config: Configuration):
         self.config = config
         self.active_tasks = set()
+        # Names of current tasks in every state, updated on each transition
+        self.by_state = {state: set() for state in State}
+        # Names of current tasks in every program group
+        self.by_group = {}
+        # All current task names in sorted order
+        self.sorted_names = []
         self.old_tasks = set()
+        self.polled_tasks = set()
+        self.deadlines = []
+        self.scheduled = {}
+        self._deadline_seq = itertools.count()
+        self._wakeup = None
         self.tasks = {}
+        soft, hard = raise_nofile_limit()
+        if soft != hard:
+            Task.restored_rlimits = {resource.RLIMIT_NOFILE: (soft, hard)}
+        self.watcher = ChildWatcher(fd_budget())
+        self.spawner = Spawner(config.settings)
+        self.capture = LogCapture()
+        self.sampler = ProcSampler()
+        self.cgroups = Cgroups(config.settings.cgroup_root)
+        # CPUs by NUMA node, read when the first program with a cpu_affinity is added
+        self.topology = None
+        self._sampled = None
+        self._stats_wanted = None
+        self._stats_wanted_until = 0
+        # Records of the previous daemon's tasks, until the first load of the programs adopts them
+        self.journal = None
+        self._journaled = {}
+        # Whether the records were handed off by reexec, which also restores the tasks without a process
+        self._handed_off = False
+        if config.settings.journal:
+            self.journal = Journal(config.settings.journal)
+            self._journaled = self.journal.load()
+        self.health = HealthChecker(config.settings.health_concurrency, self._runs_process, self._on_unhealthy)
+        self.metrics = Registry()
+        self.tasks_by_state = self.metrics.gauge("taskmaster_tasks", "Current tasks by state.", ("state",))
+        for state in State:
+            self.tasks_by_state.set(state.name, value=0)
+        self.restarts = self.metrics.counter(
+            "taskmaster_restarts", "Starts of tasks which had run before, by program.", ("program",))
+        self.state_seconds = self.metrics.counter(
+            "taskmaster_state_seconds", "Time tasks spent in a state before leaving it.", ("state",))
+        self.spawn_seconds = self.metrics.histogram(
+            "taskmaster_spawn_seconds", "Time from a start until its process is created.")
+        self.tick_seconds = self.metrics.histogram(
+            "taskmaster_tick_seconds", "Duration of a supervisor update.")
+        self.tick_phase_seconds = self.metrics.histogram(
+            "taskmaster_tick_phase_seconds", "Duration of the phases of a supervisor update.", ("phase",))
+        self.unhealthy = self.metrics.counter(
+            "taskmaster_unhealthy", "Restarts of tasks which failed their health check, by program.", ("program",))
+        self.spawning = set()
+        self._respawns = set()
+        # Reloads diff the programs against the previous ones, so they must not overlap.
+        self._reload_lock = asyncio.Lock()
+        # Autostarts waiting for the dependencies of their task, by task name
+        self._waiting = {}
+        # Futures resolved on the next transition of a task of the program group
+        self._ready_waiters = {}
         self.logger = logging.getLogger("Monitor")
         self.logger.info("Monitor initialized.")
 
+    @staticmethod
+    def iter_tasks_status(tasks, stats: dict = None):
+        """Yield the status table line by line for (name, task) pairs in their order.
+
+        stats are the sampled ProcStats by pid, resource columns show "-" without them.
+        """
+        yield Monitor.STATUS_HEADER
+        yield "-" * Monitor.STATUS_FORMAT_LEN + "\n"
+        for name, task in tasks:
+            yield Monitor.format_task_line(name, task, stats)
+
+    @staticmethod
+    def format_umask(program: Program) -> str:
+        umask = UMASK if program.umask == -1 else program.umask
+        return f"{umask:03o}"
+
+    @staticmethod
+    def format_size(size) -> str:
+        if size is None:
+            return "-"
+        for unit in ("", "K", "M", "G"):
+            if size < 1024 or unit == "G":
+                break
+            size /= 1024
+        return f"{size:.0f}{unit}" if not unit else f"{size:.1f}{unit}"
+
+    @staticmethod
+    def task_stats(task: Task, stats: dict):
+        """Sampled ProcStats of the task's process, None if there are none."""
+        if not stats or not task.is_busy():
+            return None
+        return stats.get(task.process.pid)
+
+    @staticmethod
+    def format_resources(samples) -> tuple:
+        """CPU%, RSS, FDs and Threads columns of the summed ProcStats."""
+        samples = [sample for sample in samples if sample is not None]
+        if not samples:
+            return "-", "-", "-", "-"
+        cpus = [sample.cpu for sample in samples if sample.cpu is not None]
+        fds = [sample.fds for sample in samples if sample.fds is not None]
+        return (f"{sum(cpus):.1f}" if cpus else "-",
+                Monitor.format_size(sum(sample.rss for sample in samples)),
+                sum(fds) if fds else "-",
+                sum(sample.threads for sample in samples))
+
+    @staticmethod
+    def format_task_line(name: str, task: Task, stats: dict = None) -> str:
+        retries = task.restart_count if task.process else "N/A"
+        return Monitor.STATUS_FORMAT.format(
+            name, task.status, task.get_rc(), retries, Monitor.format_umask(task.program),
+            *Monitor.format_resources([Monitor.task_stats(task, stats)]))
+
+    def format_group_line(self, group: str) -> str:
+        """One status row for all instances of the group, MIXED if their states differ."""
+        tasks = [self.tasks[name] for name in self.by_group[group]]
+        states = {task.state for task in tasks}
+        status = tasks[0].status if len(states) == 1 else "MIXED"
+        rcs = {task.get_rc() for task in tasks}
+        rc = rcs.pop() if len(rcs) == 1 else "-"
+        started = [task for task in tasks if task.process]
+        retries = sum(task.restart_count for task in started) if started else "N/A"
+        resources = self.format_resources([self.task_stats(task, self.sampler.stats) for task in tasks])
+        return Monitor.STATUS_FORMAT.format(
+            f"{group}:* ({len(tasks)})", status, rc, retries, Monitor.format_umask(tasks[0].program),
+            *resources)
+
     @staticmethod
     def format_tasks_status(tasks):
-        status = Monitor.STATUS_HEADER
-        status += "-" * Monitor.STATUS_FORMAT_LEN + "\n"
-        for name, task in sorted(tasks.items()):
-            umask = UMASK if task.program.umask == -1 else task.program.umask
-            umask = f"{umask:03o}"
-            retries = task.restart_count if task.process else "N/A"
-            status += Monitor.STATUS_FORMAT.format(name, task.status, task.get_rc(), retries, umask)
-        return status
-
-    def start_by_name(self, name: str):
+        return "".join(Monitor.iter_tasks_status(sorted(tasks.items())))
+
+    def iter_sorted_tasks(self, names=None):
+        """Yield (name, task) pairs sorted by name, for all tasks if names is None."""
+        # Take a snapshot, a streamed response may outlive a reload.
+        names = list(self.sorted_names) if names is None else sorted(set(names))
+        for name in names:
+            task = self.tasks.get(name)
+            if task is not None:
+                yield name, task
+
+    def iter_status_records(self, names=None, states=None, groups=None, fields=None, cursor=None):
+        """Yield (name, record) pairs of the matching tasks sorted by name, starting after cursor.
+
+        names, states (State members) and groups narrow down the tasks, None
+        means any. Records are dicts of the requested STATUS_FIELDS, all by default.
+        """
+        getters = [(field, STATUS_FIELDS[field]) for field in (fields or STATUS_FIELDS)]
+        stats = self.sampler.stats
+        if names is None:
+            names = self.sorted_names
+            start = 0 if cursor is None else bisect.bisect_right(names, cursor)
+            # Take a snapshot, a streamed response may outlive a reload.
+            names = names[start:]
+        else:
+            names = sorted(name for name in set(names) if cursor is None or name > cursor)
+        for name in names:
+            task = self.tasks.get(name)
+            if (task is None or (states is not None and task.state not in states)
+                    or (groups is not None and task.group not in groups)):
+                continue
+            task_stats = self.task_stats(task, stats)
+            yield name, {field: getter(name, task, task_stats) for field, getter in getters}
+
+    def names_in_states(self, *states) -> set:
+        """Names of the tasks in any of the states."""
+        return set().union(*(self.by_state[state] for state in states))
+
+    def names_in_group(self, group: str) -> set:
+        return self.by_group.get(group, set())
+
+    def expand_names(self, names) -> tuple:
+        """Resolve group addresses into task names.
+
+        "<group>:*" and a bare group name which isn't a task name stand for
+        all instances of the group, "<group>:<name>" for one of them.
+        Returns the names without duplicates and the errors of unknown groups.
+        """
+        expanded = {}
+        errors = []
+        for name in names:
+            group, sep, instance = name.partition(":")
+            if not sep:
+                if name not in self.tasks and name in self.by_group:
+                    expanded.update(dict.fromkeys(sorted(self.by_group[name])))
+                else:
+                    expanded[name] = None
+            elif group not in self.by_group:
+                errors.append(MonitorError(f"Program group '{group}' does not exist."))
+            elif instance == "*":
+                expanded.update(dict.fromkeys(sorted(self.by_group[group])))
+            elif instance in self.by_group[group]:
+                expanded[instance] = None
+            else:
+                errors.append(MonitorError(f"Task '{instance}' is not in group '{group}'."))
+        return list(expanded), errors
+
+    async def start_by_name(self, name: str):
         task = self.get_task_by_name(name)
-        if task.is_busy():
+        if task.is_busy() or name in self.spawning:
             raise MonitorError(f"Task '{name}' is busy.")
         elif task.is_done():
             raise MonitorError(f"Task '{name}' has already finished.")
-        try:
-            self.logger.debug(f"Starting task '{name}'.")
-            task.start()
-        except TaskError as e:
-            raise MonitorError(f"{name}: {e}")
+        self.logger.debug(f"Starting task '{name}'.")
+        await self._spawn(name, task)
 
-    def stop_by_name(self, name: str):
+    async def stop_by_name(self, name: str):
         task = self.get_task_by_name(name)
-        if task.is_done():
+        if name in self.spawning:
+            raise MonitorError(f"Task '{name}' is starting, try again later.")
+        elif task.is_done():
             raise MonitorError(f"Task '{name}' has already finished.")
-        elif task.status == "STOPPING":
+        elif task.state is State.STOPPING:
             raise MonitorError(f"Task '{name}' is already stopping.")
-        elif task.is_idle():
-            task.status = "STOPPED"
-            self.active_tasks.remove(name)
+        elif task.is_idle() or task.state is State.BACKOFF:
+            task.set_state(State.STOPPED)
+            self._track(name, task)
             return
         try:
             self.logger.debug(f"Stopping task '{name}'.")
             task.stop()
         except TaskError as e:
             raise MonitorError(f"{name}: {e}")
+        finally:
+            self._track(name, task)
 
-
-    def restart_by_name(self, name: str):
+    async def restart_by_name(self, name: str):
         task = self.get_task_by_name(name)
-        if task.rebooting is True:
+        if task.rebooting is True or name in self.spawning:
             raise MonitorError(f"Task '{name}' is already restarting.")
+        self.logger.debug(f"Restarting task '{name}'.")
+        if task.restart():
+            # The task is started again once its process has stopped.
+            self._track(name, task)
+        else:
+            await self._spawn(name, task)
+
+    async def bulk(self, action, names) -> list:
+        """Run a start/stop/restart action for many tasks at once.
+
+        Tasks are processed in priority order, reversed for stop, and the
+        spawner bounds how many of them are actually started concurrently.
+        Returns the errors of the tasks which failed.
+        """
+        def priority(name):
+            task = self.tasks.get(name)
+            return (task.program.priority if task else 0, name)
+
+        names = sorted(names, key=priority, reverse=action == self.stop_by_name)
+        results = await asyncio.gather(*(action(name) for name in names), return_exceptions=True)
+        errors = []
+        for result in results:
+            if isinstance(result, MonitorError):
+                errors.append(result)
+            elif isinstance(result, BaseException):
+                raise result
+        return errors
+
+    async def _spawn(self, name: str, task: Task):
+        """Start the task through the spawner."""
+        self.spawning.add(name)
+        started = time.perf_counter()
         try:
-            self.logger.debug(f"Restarting task '{name}'.")
-            task.restart()
+            await self.spawner.spawn(task)
+            self.spawn_seconds.observe(time.perf_counter() - started)
         except TaskError as e:
             raise MonitorError(f"{name}: {e}")
-        self.active_tasks.add(name)
+        finally:
+            self.spawning.discard(name)
+            if task.pipes:
+                self.capture.attach(name, task.program, task.pipes)
+                task.pipes = None
+            if task.is_busy():
+                self.cgroups.place(task.group, task.program, task.process.pid)
+            if self.tasks.get(name) is not task and task.is_busy():
+                # Retired by a reload while it was being spawned.
+                try:
+                    task.stop()
+                    self.old_tasks.add(task)
+                except TaskError:
+                    pass
+            self._track(name, task)
+
+    def _respawn(self, name: str, task: Task):
+        """Start a finished task again in the background, e.g. on autorestart."""
+        async def _run():
+            try:
+                await self._spawn(name, task)
+            except MonitorError as e:
+                self.logger.error(f"Failed to restart task '{name}': {e}")
+
+        respawn = asyncio.get_running_loop().create_task(_run())
+        self._respawns.add(respawn)
+        respawn.add_done_callback(self._respawns.discard)
+
+    def tail_output(self, name: str, stream: str = "stdout", follow: bool = False):
+        """Async iterator over the recent output of the task, followed by new output if follow is set.
+
+        Captured output comes from the task's ring buffer as bytes, otherwise
+        the program's log file is read in FileSegments.
+        """
+        names, errors = self.expand_names([name])
+        if errors:
+            raise errors[0]
+        if len(names) != 1:
+            raise MonitorError(f"'{name}' addresses {len(names)} tasks, tail needs exactly one.")
+        name = names[0]
+        program = self.get_task_by_name(name).program
+        if program.capture:
+            return tail_buffer(self.capture.buffer(name, stream, program.capture_buffer), follow=follow)
+        path = getattr(program, stream)
+        if not path:
+            raise MonitorError(f"Task '{name}' has no {stream} log.")
+        return tail_file(path, follow=follow)
 
     def get_task_by_name(self, name) -> Task:
         if name not in self.tasks:
@@ -241,26 +763,291 @@ class Monitor:
         return self.tasks[name]
 
     def update(self):
-        for name in self.active_tasks:
-            self.tasks[name].update_status()
-        self.active_tasks = set([name for name in self.active_tasks if self._task_is_active(name)])
+        """Update tasks whose process exited or whose deadline has passed.
 
-    def _task_is_active(self, name) -> bool:
-        task = self.tasks[name]
-        if task.is_done():
-            return False
-        return True
+        The phases are timed: reap collects exited children, poll expired
+        deadlines and polled tasks, transition updates the tasks and
+        restart schedules their respawns.
+        """
+        started = time.perf_counter()
+        touched = {task: name for name, task in self.watcher.exited()}
+        reaped = time.perf_counter()
+        now = time.time()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, _, name, task = heapq.heappop(self.deadlines)
+            if self.scheduled.get(task) == deadline:
+                del self.scheduled[task]
+                touched[task] = name
+        for name in self.polled_tasks:
+            touched[self.tasks[name]] = name
+        if not self.watcher.enabled:
+            for task in self.old_tasks:
+                touched.setdefault(task, None)
+        polled = time.perf_counter()
+        restarts = []
+        for task, name in touched.items():
+            # A retired task may share its name with the current one being spawned.
+            if name in self.spawning and self.tasks.get(name) is task:
+                continue
+            restart = task.update_status()
+            self._track(name, task)
+            if restart and self.tasks.get(name) is task:
+                restarts.append((name, task))
+        transitioned = time.perf_counter()
+        for name, task in restarts:
+            self.spawning.add(name)
+            self._respawn(name, task)
+        finished = time.perf_counter()
+        self._observe_tick(finished - started, len(touched), (
+            ("reap", reaped - started), ("poll", polled - reaped),
+            ("transition", transitioned - polled), ("restart", finished - transitioned)))
+
+    def _observe_tick(self, duration: float, task_cnt: int, phases: tuple):
+        self.tick_seconds.observe(duration)
+        for phase, seconds in phases:
+            self.tick_phase_seconds.observe(seconds, phase)
+        slow_tick = self.config.settings.slow_tick
+        if slow_tick and duration >= slow_tick:
+            timings = ", ".join(f"{phase} {seconds * 1000:.1f}ms" for phase, seconds in phases)
+            self.logger.warning(f"Slow tick: {duration * 1000:.1f}ms for {task_cnt} tasks ({timings}).")
+
+    async def supervise(self, poll_interval: float = 0.5):
+        """Update tasks on child exits and deadlines, sleeping in between."""
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        if self.watcher.enabled:
+            loop.add_reader(self.watcher.fileno(), self._wakeup.set)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.next_timeout(poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                self.update()
+        finally:
+            if self.watcher.enabled:
+                loop.remove_reader(self.watcher.fileno())
+            self.watcher.close()
+            self.spawner.close()
+            self.capture.close()
+            if self.journal is not None:
+                self.journal.close()
+            self._wakeup = None
+
+    async def sample_resources(self):
+        """Sample resource usage of all running processes every stats_interval seconds.
+
+        Sampling only runs while status requests want the resource usage,
+        see want_stats(), and sleeps otherwise. The /proc scan runs in a
+        worker thread, status only reads its cached result.
+        """
+        self._sampled = asyncio.Event()
+        self._stats_wanted = asyncio.Event()
+        try:
+            while True:
+                interval = self.config.settings.stats_interval
+                if interval and time.monotonic() < self._stats_wanted_until:
+                    pids = [self.tasks[name].process.pid
+                            for name in self.names_in_states(State.STARTING, State.RUNNING, State.STOPPING)
+                            if name in self.tasks]
+                    await asyncio.to_thread(self.sampler.sample, pids)
+                    self._sampled.set()
+                    self._sampled.clear()
+                    await asyncio.sleep(interval)
+                else:
+                    self.sampler.reset()
+                    self._stats_wanted.clear()
+                    await self._stats_wanted.wait()
+        finally:
+            self._sampled = None
+            self._stats_wanted = None
+
+    def want_stats(self):
+        """Keep sampling resource usage for the next STATS_IDLE_TIMEOUT seconds."""
+        self._stats_wanted_until = time.monotonic() + STATS_IDLE_TIMEOUT
+        if self._stats_wanted is not None:
+            self._stats_wanted.set()
+
+    async def request_stats(self):
+        """Want resource usage, and wait for a first sample if the sampler was idle."""
+        idle = self.sampler.sampled_at is None
+        self.want_stats()
+        if idle and self._sampled is not None and self.config.settings.stats_interval:
+            await self._sampled.wait()
+
+    async def wait_sample(self):
+        """Wait for the next resource sample, or SAMPLE_DISABLED_CHECK seconds if sampling is off."""
+        if self._sampled is None or not self.config.settings.stats_interval:
+            await asyncio.sleep(SAMPLE_DISABLED_CHECK)
+        else:
+            await self._sampled.wait()
+
+    async def check_health(self):
+        """Probe the health checks of running tasks."""
+        await self.health.run()
+
+    def _runs_process(self, name: str, task: Task, pid: int) -> bool:
+        """Whether the task is current and still RUNNING the process."""
+        return (self.tasks.get(name) is task and task.state is State.RUNNING
+                and not task.rebooting and task.process.pid == pid)
+
+    def _on_unhealthy(self, name: str, task: Task):
+        """Stop a task which failed its health check, it is restarted like after an unexpected exit.
+
+        The restarts count against startretries, with backoff, until the task is FATAL.
+        """
+        self.logger.warning(f"Task '{name}' failed its health check {task.program.healthcheck.retries} times, "
+                            f"restarting it.")
+        self.unhealthy.inc(task.group)
+        try:
+            task.stop_unhealthy()
+        except TaskError as e:
+            self.logger.error(f"Failed to stop unhealthy task '{name}': {e}")
+        self._track(name, task)
+
+    def wakeup(self):
+        """Make the supervisor recompute its sleep time."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def next_timeout(self, poll_interval: float):
+        """Seconds the server may sleep before the monitor needs an update.
+
+        None means there is nothing to wait for except child exits and requests.
+        """
+        if self.polled_tasks or (self.old_tasks and not self.watcher.enabled):
+            return poll_interval
+        if not self.deadlines:
+            return None
+        return max(0.0, self.deadlines[0][0] - time.time())
+
+    def _track(self, name: str, task: Task):
+        """Refresh bookkeeping of the task after it might have changed its status."""
+        current = self.tasks.get(name) is task
+        self._schedule(name, task)
+        if task.is_busy():
+            watched = self.watcher.watch(name, task)
+            if current and not watched:
+                if not self.polled_tasks:
+                    self.wakeup()
+                self.polled_tasks.add(name)
+            elif current:
+                self.polled_tasks.discard(name)
+        elif current:
+            self.polled_tasks.discard(name)
+        else:
+            self.old_tasks.discard(task)
 
-    def reload_config(self):
-        """Reload the configuration."""
+    def _on_transition(self, task: Task, old_state: State, new_state: State):
+        """Keep the state indexes and metrics in sync with the task's state."""
+        self.by_state[old_state].discard(task.name)
+        self.by_state[new_state].add(task.name)
+        now = time.monotonic()
+        self.state_seconds.inc(old_state.name, amount=now - task.state_since)
+        task.state_since = now
+        self.tasks_by_state.dec(old_state.name)
+        self.tasks_by_state.inc(new_state.name)
+        if new_state is State.STARTING and old_state is not State.CREATED:
+            self.restarts.inc(task.group)
+        if new_state in Task.DONE:
+            self.active_tasks.discard(task.name)
+        else:
+            self.active_tasks.add(task.name)
+        if new_state is State.RUNNING and task.program.healthcheck is not None:
+            self.health.watch(task.name, task)
+        if self.journal is not None:
+            self.journal.record(task.name, self.task_record(task))
+        waiters = self._ready_waiters.pop(task.group, None)
+        if waiters:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    def task_record(self, task: Task) -> dict:
+        """The task's state, and its process if it is busy, as recorded in the journal."""
+        record = {"name": task.name, "state": task.state.name, "restart_count": task.restart_count,
+                  "cmd": task.program.cmd}
+        if task.rebooting:
+            record["rebooting"] = True
+        if task.state is State.BACKOFF:
+            record["backoff_until"] = task.backoff_until
+        if task.is_busy():
+            pid = task.process.pid
+            previous = self.journal.get(task.name) if self.journal is not None else None
+            if previous and previous.get("pid") == pid:
+                starttime = previous["starttime"]
+            else:
+                starttime = read_starttime(pid)
+            record.update(pid=pid, starttime=starttime, start_time=task.start_time)
+            if task.state is State.STOPPING:
+                record["stop_time"] = task.stop_time
+        return record
+
+    def handoff(self) -> list:
+        """Records of the tasks which were started for a re-executed daemon, see take_over.
+
+        The output pipes of captured tasks are detached and left open for it.
+        """
+        pipes = self.capture.detach()
+        records = []
+        for name, task in self.tasks.items():
+            if task.is_idle():
+                continue
+            record = self.task_record(task)
+            if task.is_busy():
+                # The process stays our child, even if it exits before the new daemon runs.
+                record["child"] = True
+            if name in pipes:
+                record["pipes"] = pipes[name]
+            records.append(record)
+        return records
+
+    def take_over(self, records: list):
+        """Adopt the processes of the handed off records instead of the journaled ones.
+
+        Tasks in BACKOFF or finished are restored as well, so they aren't autostarted again.
+        """
+        self._journaled = {record["name"]: record for record in records}
+        self._handed_off = True
+
+    def _schedule(self, name: str, task: Task):
+        """Register the next deadline of the task in the deadline heap."""
+        deadline = task.deadline()
+        if deadline is None:
+            self.scheduled.pop(task, None)
+            return
+        if self.scheduled.get(task) == deadline:
+            return
+        self.scheduled[task] = deadline
+        if not self.deadlines or deadline < self.deadlines[0][0]:
+            self.wakeup()
+        heapq.heappush(self.deadlines, (deadline, next(self._deadline_seq), name, task))
+
+    async def reload_config(self):
+        """Reload the configuration, after any reload in progress."""
+        async with self._reload_lock:
+            await self._reload_config()
+
+    async def _reload_config(self):
         self.logger.debug("Reloading configuration.")
         old_progs = self.config.programs
-        self.config.reload_config()
+        # Parsing a large file shouldn't stall supervision and other clients.
+        await asyncio.to_thread(self.config.reload_config)
         new_progs = self.config.programs
+        self.spawner.configure(self.config.settings)
+        self.cgroups.configure(self.config.settings.cgroup_root)
+        self.health.configure(self.config.settings.health_concurrency)
+        if new_progs is old_progs and self.tasks:
+            return
+        group_of = {name: (group, index) for group, names in self.config.groups.items()
+                    for index, name in enumerate(names)}
         # Initialize tasks
         if not self.tasks:
             for name, program in new_progs.items():
-                self._create_task(name, program)
+                self._create_task(name, program, *group_of.get(name, (None, 0)))
+            adopted = self._adopt()
+            await self._autostart(name for name in new_progs if name not in adopted)
             return
 
         old_ids = set(old_progs.keys())
@@ -270,37 +1057,208 @@ class Monitor:
         self.logger.debug(f"Added programs: {added_ids}")
         for name in added_ids:
             self.logger.info(f"Adding program '{name}'.")
-            self._create_task(name, new_progs[name])
+            self._create_task(name, new_progs[name], *group_of.get(name, (None, 0)))
         # Process removed programs
         removed_ids = old_ids - new_ids
         self.logger.debug(f"Removed programs: {removed_ids or '0'}")
         for name in removed_ids:
             self.logger.info(f"Removing program '{name}'.")
             self._retire_task(name)
-        # Process same programs
-        same_ids = new_ids & old_ids
-        self.logger.debug(f"Same programs: {same_ids}")
-        for name in same_ids:
-            if old_progs[name] == new_progs[name]:
-                self.logger.info(f"Program '{name}' has not changed.")
-                continue
+        # Process changed programs, unchanged sections keep their Program objects
+        changed_ids = [name for name in new_ids & old_ids if old_progs[name] is not new_progs[name]]
+        self.logger.debug(f"Changed programs: {changed_ids}")
+        for name in changed_ids:
+            self.logger.info(f"Program '{name}' has changed.")
             self._retire_task(name)
-            self._create_task(name, new_progs[name])
+            self._create_task(name, new_progs[name], *group_of.get(name, (None, 0)))
+        unchanged_cnt = len(new_ids & old_ids) - len(changed_ids)
+        self.logger.info(f"{unchanged_cnt} programs have not changed.")
+        await self._autostart(itertools.chain(added_ids, changed_ids))
+
+    def _adopt(self) -> set:
+        """Take over the processes recorded as running by the journal or a handoff, if they still are.
 
-    def _create_task(self, name, program: Program):
-        self.tasks[name] = task = Task(program)
-        if program.autostart:
+        A process is only adopted if its command is unchanged and its pid
+        still has the recorded start time, i.e. it wasn't reused. Captured
+        processes are only adopted with the output pipes handed off by
+        reexec, nothing could read their output otherwise. Handed off
+        output pipes of processes which aren't adopted are closed.
+        Handed off tasks without a process are restored too.
+        Returns the names of the adopted and restored tasks.
+        """
+        journaled, self._journaled = self._journaled, {}
+        handed_off, self._handed_off = self._handed_off, False
+        adopted = set()
+        restored = set()
+        for name, record in journaled.items():
+            task = self.tasks.get(name)
+            pipes = record.get("pipes")
+            if task is None:
+                if self.journal is not None:
+                    self.journal.record(name)
+            elif self._adopt_task(task, record):
+                if pipes:
+                    self.capture.attach(name, task.program, pipes)
+                    pipes = None
+                self._track(name, task)
+                adopted.add(name)
+            elif handed_off and self._restore_task(task, record):
+                self._track(name, task)
+                restored.add(name)
+            for fd in (pipes or {}).values():
+                os.close(fd)
+        if adopted:
+            self.logger.info(f"Adopted {len(adopted)} running processes.")
+        return adopted | restored
+
+    @staticmethod
+    def _adopt_task(task: Task, record: dict) -> bool:
+        state = State.__members__.get(record.get("state"))
+        if state not in Task.BUSY or record.get("cmd") != task.program.cmd:
+            return False
+        if task.program.capture and not record.get("pipes"):
+            return False
+        pid, starttime = record.get("pid"), record.get("starttime")
+        if not pid or starttime is None:
+            return False
+        # The pid of an unreaped child can't have been reused, but it may be a zombie by now.
+        if not record.get("child") and read_starttime(pid) != starttime:
+            return False
+        task.restart_count = record.get("restart_count", 0)
+        task.started(AdoptedProcess(pid, starttime))
+        task.rebooting = bool(record.get("rebooting"))
+        task.start_time = record.get("start_time") or task.start_time
+        if state is State.STOPPING:
+            task.stop_time = record.get("stop_time") or time.time()
+        if state is not State.STARTING:
+            task.set_state(state)
+        return True
+
+    @staticmethod
+    def _restore_task(task: Task, record: dict) -> bool:
+        """Restore a task in BACKOFF or finished, with its restart count."""
+        state = State.__members__.get(record.get("state"))
+        if (state not in Task.DONE and state is not State.BACKOFF) or record.get("cmd") != task.program.cmd:
+            return False
+        if state is State.BACKOFF:
+            if not isinstance(record.get("backoff_until"), (int, float)):
+                return False
+            task.backoff_until = record["backoff_until"]
+        task.restart_count = record.get("restart_count", 0)
+        task.set_state(state)
+        return True
+
+    async def _autostart(self, names):
+        """Start the autostart tasks, tasks with dependencies as soon as those are ready.
+
+        Independent branches of the dependency graph start in parallel, so
+        everything is up after about the time of the longest chain.
+        """
+        names = [name for name in names if self.tasks[name].program.autostart]
+        independent = []
+        for name in names:
+            task = self.tasks[name]
+            if task.program.depends_on:
+                self._start_when_ready(name, task)
+            else:
+                independent.append(name)
+        for e in await self.bulk(self.start_by_name, independent):
+            self.logger.error(f"Failed to autostart program: {e}")
+
+    def _start_when_ready(self, name: str, task: Task):
+        """Autostart the task in the background once the programs it depends on are ready."""
+        async def _run():
             try:
-                task.start()
-            except TaskError as e:
-                self.logger.error(f"Failed to autostart program '{name}': {e}")
+                for group in task.program.depends_on:
+                    await self.wait_ready(group)
+                # It may have been started by hand or retired meanwhile.
+                if self.tasks.get(name) is task and task.is_idle() and name not in self.spawning:
+                    await self.start_by_name(name)
+            except MonitorError as e:
+                self.logger.error(f"Failed to autostart program: {e}")
+            finally:
+                if self._waiting.get(name) is waiting:
+                    del self._waiting[name]
+
+        self.logger.debug(f"Task '{name}' waits for {', '.join(task.program.depends_on)}.")
+        waiting = asyncio.get_running_loop().create_task(_run())
+        self._waiting[name] = waiting
+
+    async def wait_ready(self, group: str):
+        """Wait until all tasks of the program group are ready for their dependents.
+
+        A task is ready when it is RUNNING, or once its ready condition holds
+        if the program has one, or when it has SUCCEEDED. Raises MonitorError
+        if a task of the group ended otherwise.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            ready, check = await self._group_ready(group)
+            if ready:
+                return
+            waiter = loop.create_future()
+            self._ready_waiters.setdefault(group, []).append(waiter)
+            # Ready conditions are checked periodically, states on every transition.
+            await asyncio.wait((waiter,), timeout=READY_CHECK_INTERVAL if check else None)
+            waiters = self._ready_waiters.get(group)
+            if waiters and not waiter.done():
+                waiters.remove(waiter)
+
+    async def _group_ready(self, group: str) -> tuple:
+        """Whether the group is ready, and whether that depends on a ready condition to check again."""
+        names = self.by_group.get(group)
+        if not names:
+            raise MonitorError(f"Dependency '{group}' does not exist.")
+        ready, check = True, False
+        for name in sorted(names):
+            task = self.tasks[name]
+            if task.state is State.SUCCEEDED:
+                continue
+            if task.is_done():
+                raise MonitorError(f"Dependency '{name}' is {task.status}.")
+            condition = task.program.ready
+            if condition is not None and task.state in (State.STARTING, State.RUNNING):
+                if not await check_ready(condition):
+                    ready, check = False, True
+            elif task.state is not State.RUNNING:
+                ready = False
+        return ready, check
+
+    def _create_task(self, name, program: Program, group: str = None, index: int = 0):
+        self.tasks[name] = task = Task(program, name, group, index)
+        if program.cpu_affinity is not None:
+            if self.topology is None:
+                self.topology = cpu_topology()
+            task.cpus = instance_cpus(program.cpu_affinity, index, self.topology)
+        task.listener = self._on_transition
+        self.by_state[task.state].add(name)
+        self.tasks_by_state.inc(task.state.name)
+        self.by_group.setdefault(task.group, set()).add(name)
+        bisect.insort(self.sorted_names, name)
         self.active_tasks.add(name)
 
     def _retire_task(self, name: str):
         task = self.tasks.pop(name)
+        task.listener = None
+        self.by_state[task.state].discard(name)
+        self.tasks_by_state.dec(task.state.name)
+        group = self.by_group[task.group]
+        group.discard(name)
+        if not group:
+            del self.by_group[task.group]
+        del self.sorted_names[bisect.bisect_left(self.sorted_names, name)]
+        self.polled_tasks.discard(name)
+        self.scheduled.pop(task, None)
+        self.capture.forget(name)
+        waiting = self._waiting.pop(name, None)
+        if waiting is not None:
+            waiting.cancel()
+        if self.journal is not None:
+            self.journal.record(name)
         if name in self.active_tasks:
             self.active_tasks.remove(name)
             if task.is_busy():
-                if task.status != "STOPPING":
+                if task.state is not State.STOPPING:
                     task.stop()
                 self.old_tasks.add(task)
+                self._track(name, task)
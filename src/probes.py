@@ -0,0 +1,152 @@
+import asyncio
+import os
+from typing import NamedTuple
+
+PROBE_TIMEOUT = 1
+# Readiness conditions of a program besides being RUNNING after startsecs
+READY_KINDS = ("socket", "file")
+HEALTH_KINDS = ("exec", "tcp", "unix", "http")
+
+
+class HealthCheck(NamedTuple):
+    kind: str
+    target: object  # Command args, parsed address, or (address, path) for http
+    interval: float = 10
+    timeout: float = 2
+    retries: int = 3  # Consecutive failures which make the task unhealthy
+
+
+class ProbeError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+def parse_address(address: str) -> tuple:
+    """Parse a socket address: a unix socket path, or host:port. Returns (path, None) or (host, port)."""
+    if "/" in address:
+        return address, None
+    host, sep, port = address.rpartition(":")
+    if not sep or not port.isdigit() or not 0 < int(port) < 65536:
+        raise ProbeError(f"Invalid socket address: {address}, expected a path or host:port")
+    return host or "127.0.0.1", int(port)
+
+
+def parse_ready(ready: dict) -> tuple:
+    """Convert a program ready condition like {"socket": "127.0.0.1:5432"} to ("socket", ("127.0.0.1", 5432))."""
+    if not isinstance(ready, dict) or len(ready) != 1:
+        raise ProbeError(f"ready must be one of {', '.join(READY_KINDS)} with its target")
+    (kind, target), = ready.items()
+    if kind not in READY_KINDS or not isinstance(target, str) or not target:
+        raise ProbeError(f"ready must be one of {', '.join(READY_KINDS)} with its target")
+    if kind == "socket":
+        return kind, parse_address(target)
+    return kind, target
+
+
+def parse_healthcheck(config: dict) -> HealthCheck:
+    """Convert a program healthcheck like {"http": "127.0.0.1:8080/health", "interval": 5} to a HealthCheck."""
+    if not isinstance(config, dict):
+        raise ProbeError("healthcheck must be a mapping")
+    config = dict(config)
+    kinds = [kind for kind in HEALTH_KINDS if kind in config]
+    if len(kinds) != 1:
+        raise ProbeError(f"healthcheck must have one of {', '.join(HEALTH_KINDS)}")
+    kind = kinds[0]
+    value = config.pop(kind)
+    if not isinstance(value, str) or not value:
+        raise ProbeError(f"healthcheck {kind} must be a non-empty string")
+    if kind == "exec":
+        target = value.split()
+    elif kind == "http":
+        address, _, path = value.removeprefix("http://").partition("/")
+        if "/" in address or ":" not in address:
+            raise ProbeError(f"healthcheck http must be host:port[/path], not {value}")
+        target = parse_address(address), "/" + path
+    else:
+        target = parse_address(value)
+        if (target[1] is None) != (kind == "unix"):
+            raise ProbeError(f"Invalid healthcheck {kind} address: {value}")
+    try:
+        check = HealthCheck(kind, target, **config)
+    except TypeError as e:
+        raise ProbeError(f"Invalid healthcheck option: {e}")
+    for option in ("interval", "timeout"):
+        value = getattr(check, option)
+        if not isinstance(value, (int, float)) or value <= 0:
+            raise ProbeError(f"healthcheck {option} must be a number greater than 0")
+    if not isinstance(check.retries, int) or check.retries < 1:
+        raise ProbeError("healthcheck retries must be an integer greater than 0")
+    return check
+
+
+async def check_socket(address: tuple, timeout: float = PROBE_TIMEOUT) -> bool:
+    """Whether something accepts connections on the parsed address."""
+    host, port = address
+    try:
+        if port is None:
+            connecting = asyncio.open_unix_connection(host)
+        else:
+            connecting = asyncio.open_connection(host, port)
+        _, writer = await asyncio.wait_for(connecting, timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+
+async def check_ready(ready: tuple) -> bool:
+    """Whether the parsed ready condition holds."""
+    kind, target = ready
+    if kind == "file":
+        return os.path.exists(target)
+    return await check_socket(target)
+
+
+async def check_exec(args: list) -> bool:
+    """Whether the command exits with 0. It is killed if the probe is cancelled, e.g. by its timeout."""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL)
+    except OSError:
+        return False
+    try:
+        return await process.wait() == 0
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await asyncio.shield(process.wait())
+
+
+async def check_http(address: tuple, path: str) -> bool:
+    """Whether a GET of the path answers with a 2xx or 3xx status."""
+    host, port = address
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        return False
+    try:
+        writer.write(f"GET {path} HTTP/1.0\r\nHost: {host}\r\n\r\n".encode())
+        await writer.drain()
+        status_line = await reader.readline()
+    except (OSError, ValueError):
+        return False
+    finally:
+        writer.close()
+    parts = status_line.split()
+    return len(parts) >= 2 and parts[0].startswith(b"HTTP/") and parts[1][:1] in (b"2", b"3")
+
+
+async def run_health_check(check: HealthCheck) -> bool:
+    """Run one probe of the health check, a probe running out of time fails."""
+    if check.kind == "exec":
+        probe = check_exec(check.target)
+    elif check.kind == "http":
+        probe = check_http(*check.target)
+    else:
+        probe = check_socket(check.target, check.timeout)
+    try:
+        return await asyncio.wait_for(probe, check.timeout)
+    except asyncio.TimeoutError:
+        return False
@@ -0,0 +1,93 @@
+import logging
+import os
+import time
+from typing import NamedTuple
+
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+class ProcStats(NamedTuple):
+    cpu: float  # Percent of one CPU since the previous sample, None on the first one
+    rss: int  # Bytes
+    fds: int  # None if /proc/<pid>/fd can't be read
+    threads: int
+
+
+def read_proc(pid: int):
+    """Read (starttime, cpu ticks, rss bytes, threads, fds) of the process, None if it is gone."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    # The command name may contain spaces and parentheses, fields follow the last ")".
+    fields = data[data.rindex(b")") + 2:].split()
+    ticks = int(fields[11]) + int(fields[12])
+    threads = int(fields[17])
+    starttime = int(fields[19])
+    rss = int(fields[21]) * PAGE_SIZE
+    try:
+        fds = len(os.listdir(f"/proc/{pid}/fd"))
+    except OSError:
+        fds = None
+    return starttime, ticks, rss, threads, fds
+
+
+def read_starttime(pid: int):
+    """Start time of a live process in clock ticks since boot, None if it is gone or a zombie."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    fields = data[data.rindex(b")") + 2:].split()
+    if fields[0] in (b"Z", b"X"):
+        return None
+    return int(fields[19])
+
+
+class ProcSampler:
+    """Sample resource usage of processes from /proc in one batch.
+
+    sample() is meant to run periodically in a worker thread. Readers only
+    look up the cached `stats` of the last sample, which is replaced as a
+    whole, so they never touch /proc themselves.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.sampled_at = None
+        # pid -> (starttime, cpu ticks, monotonic time) of the previous sample
+        self._ticks = {}
+        self.logger = logging.getLogger("Monitor")
+
+    def sample(self, pids) -> dict:
+        stats = {}
+        ticks = {}
+        for pid in pids:
+            now = time.monotonic()
+            proc = read_proc(pid)
+            if proc is None:
+                continue
+            starttime, cpu_ticks, rss, threads, fds = proc
+            cpu = None
+            previous = self._ticks.get(pid)
+            # The same pid with another start time is a different process.
+            if previous and previous[0] == starttime and now > previous[2]:
+                cpu = (cpu_ticks - previous[1]) / CLK_TCK / (now - previous[2]) * 100
+            ticks[pid] = (starttime, cpu_ticks, now)
+            stats[pid] = ProcStats(cpu, rss, fds, threads)
+        self._ticks = ticks
+        self.stats = stats
+        self.sampled_at = time.time()
+        return stats
+
+    def reset(self):
+        """Forget the last sample, e.g. while nobody looks at it."""
+        self.stats = {}
+        self.sampled_at = None
+        self._ticks = {}
+
+    def get(self, pid: int):
+        return self.stats.get(pid)
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import socket
+import struct
+
+MSG_ENCODING = 'utf-8'
+# Frame header: payload length as unsigned 32-bit big-endian integer
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 1 << 20
+# Size of a response chunk while streaming long messages
+CHUNK_SIZE = 64 * 1024
+# A frame with a "raw" size is followed by that many bytes of raw data,
+# returned in the frame's "data" by the readers.
+RAW_KEY = "raw"
+
+
+class ProtocolError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+
+def encode_frame(message: dict) -> bytes:
+    """Encode a message as a length-prefixed JSON frame."""
+    payload = json.dumps(message).encode(MSG_ENCODING)
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(payload)} bytes exceeds {MAX_FRAME_SIZE} bytes")
+    return HEADER.pack(len(payload)) + payload
+
+
+def decode_payload(payload: bytes) -> dict:
+    try:
+        message = json.loads(payload.decode(MSG_ENCODING))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ProtocolError(f"Malformed frame: {e}")
+    if not isinstance(message, dict):
+        raise ProtocolError("Malformed frame: JSON object expected")
+    return message
+
+
+def _check_size(size: int):
+    if size > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {size} bytes exceeds {MAX_FRAME_SIZE} bytes")
+
+
+def _raw_size(message: dict) -> int:
+    size = message[RAW_KEY]
+    if not isinstance(size, int) or size < 0:
+        raise ProtocolError(f"Malformed frame: invalid raw size {size!r}")
+    _check_size(size)
+    return size
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    """Read one frame from the stream. Returns None on a clean EOF."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ProtocolError("Connection closed in the middle of a frame header")
+        return None
+    size, = HEADER.unpack(header)
+    _check_size(size)
+    try:
+        message = decode_payload(await reader.readexactly(size))
+        if RAW_KEY in message:
+            message["data"] = await reader.readexactly(_raw_size(message))
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("Connection closed in the middle of a frame")
+    return message
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ProtocolError("Connection closed by the peer")
+        data += chunk
+    return bytes(data)
+
+
+def recv_frame(sock: socket.socket) -> dict:
+    """Receive one frame from a blocking socket."""
+    size, = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    _check_size(size)
+    message = decode_payload(_recv_exactly(sock, size))
+    if RAW_KEY in message:
+        message["data"] = _recv_exactly(sock, _raw_size(message))
+    return message
+
+
+def send_frame(sock: socket.socket, message: dict):
+    """Send one frame over a blocking socket."""
+    sock.sendall(encode_frame(message))
@@ -1,23 +1,46 @@
+import asyncio
+import cProfile
+import io
+import itertools
+import json
 import os
-import threading
+import pstats
 import shlex
 import getopt
+import socket
+import sys
+import tempfile
+from collections.abc import AsyncIterator, Iterator
 
 import atexit
 
 from daemon import DaemonContext
-from socketserver import UnixStreamServer, StreamRequestHandler
 import signal
-import json
 import logging
 import logging.config
 
 from configuration import Configuration
-from monitor import Monitor, MonitorError
+from monitor import STATUS_FIELDS, Monitor, MonitorError, State
 from configuration import ConfigurationError
-
-BUFFER_SIZE = 1024
-MSG_ENCODING = 'utf-8'
+from logcapture import FileSegment
+from metrics import MetricsServer
+from protocol import CHUNK_SIZE, MAX_FRAME_SIZE, RAW_KEY, ProtocolError, encode_frame, read_frame
+
+REQUEST_TIMEOUT = 10
+MAX_PROFILE_SECONDS = 300
+# Functions listed in a profile report
+PROFILE_LINES = 40
+CLEAR_SCREEN = "\033[H\033[2J"
+# Requests of one connection which may be processed at the same time
+MAX_PIPELINED = 32
+# Set to the fd of the handed over state in a daemon started by reexec
+REEXEC_ENV = "TASKMASTER_REEXEC"
+# Since Python 3.13 a closed unix server unlinks its socket path, which a re-executed daemon still serves.
+# The path is removed at exit instead.
+UNIX_SERVER_OPTIONS = {"cleanup_socket": False} if sys.version_info >= (3, 13) else {}
+# Records per page of the status service, by default and at most
+STATUS_PAGE_SIZE = 500
+MAX_STATUS_PAGE_SIZE = 2000
 
 
 def clean_up(*files):
@@ -26,7 +49,16 @@ def clean_up(*files):
             os.remove(file)
 
 
-class Server(UnixStreamServer):
+def read_handoff():
+    """State handed over by reexec, None if the daemon was started normally."""
+    fd = os.environ.pop(REEXEC_ENV, None)
+    if fd is None:
+        return None
+    with os.fdopen(int(fd)) as f:
+        return json.load(f)
+
+
+class Server:
     commands_info = {
         "start": {
             "help": "Start tasks",
@@ -34,6 +66,7 @@ class Server(UnixStreamServer):
             "args": "+",
             "usage": "Usage: start <task_list | option>\n\n"
                      "Start provided tasks.\n"
+                     "Use <program>:* to address all instances of a program.\n"
         },
         "stop": {
             "help": "Stop tasks",
@@ -41,21 +74,52 @@ class Server(UnixStreamServer):
             "args": "+",
             "usage": "Usage: stop <task_list | option>\n\n"
                      "Stop provided tasks.\n"
+                     "Use <program>:* to address all instances of a program.\n"
         },
         "restart": {
             "help": "Restart tasks",
             "options": ["all", "help"],
             "args": "+",
             "usage": "Usage: restart <task_list | option>\n\n"
-                     "Restart provided tasks.\n",
+                     "Restart provided tasks.\n"
+                     "Use <program>:* to address all instances of a program.\n",
     },
         "status": {
             "help": "Show the status of tasks",
-            "options": ["help"],
+            "options": ["groups", "watch", "json", "fields=", "state=", "help"],
+            "flags": ["watch", "json"],
+            # Options which take a value, passed as keyword arguments
+            "values": ["fields", "state"],
             "args": "*",
-            "usage": "Usage: status [task_list | option]\n\n"
+            "usage": "Usage: status [task_list | option] [--watch]\n"
+                     "       status [task_list] --json [--fields=<field,...>] [--state=<state,...>]\n\n"
                      "Show status for the provided tasks.\n"
-                     "Shows status for all tasks in case no tasks were provided.\n",
+                     "Shows status for all tasks in case no tasks were provided.\n"
+                     "A program name shows one row for all of its instances,\n"
+                     "<program>:* shows every instance.\n"
+                     "With --watch the status is refreshed after every resource sample.\n"
+                     "With --json every task is a JSON object on its own line, with the fields\n"
+                     f"{', '.join(STATUS_FIELDS)}.\n",
+        },
+        "tail": {
+            "help": "Show the output of a task",
+            "options": ["follow", "stderr", "help"],
+            "short_options": {"f": "follow"},
+            # Options which can be combined with the task
+            "flags": ["follow", "stderr"],
+            "args": "1",
+            "usage": "Usage: tail <task> [--follow | -f] [--stderr]\n\n"
+                     "Show the last output of the task.\n"
+                     "With --follow new output is streamed until interrupted.\n",
+        },
+        "profile": {
+            "help": "Profile the daemon",
+            "options": ["help"],
+            "args": "1",
+            "usage": "Usage: profile <seconds>\n\n"
+                     "Profile the daemon's event loop for the given time and show\n"
+                     f"the {PROFILE_LINES} functions with the highest cumulative time.\n"
+                     "Spawner and sampler threads are not profiled.\n",
         },
         "reload": {
             "help": "Reload the configuration",
@@ -65,6 +129,14 @@ class Server(UnixStreamServer):
             "help": "Stop the server",
             "options": ["help"],
         },
+        "reexec": {
+            "help": "Restart the server in place",
+            "options": ["help"],
+            "usage": "Usage: reexec\n\n"
+                     "Execute a fresh daemon in place of the running one.\n"
+                     "It takes over the control socket and the running tasks,\n"
+                     "which are not restarted, and reads the configuration again.\n",
+        },
         "help": {
             "help": "Show the available commands",
         },
@@ -72,10 +144,19 @@ class Server(UnixStreamServer):
 
     service_api = [
         "_service_get_tasks",
+        "_service_subscribe_tasks",
+        "_service_get_status",
     ]
 
     options_info = {
         "all": "Execute for all tasks",
+        "groups": "Show one row per program",
+        "watch": "Refresh until interrupted",
+        "json": "One JSON object per task",
+        "fields": "Fields of the JSON objects",
+        "state": "Only tasks in these states",
+        "follow": "Keep streaming new output",
+        "stderr": "Show stderr instead of stdout",
         "help": "Show this message",
     }
     # Default logging configuration with disabled loggers
@@ -97,7 +178,6 @@ class Server(UnixStreamServer):
 
     def __init__(self, config_path: str, socket_path: str, log_path: str, pid_path: str):
         """Initialize the server."""
-        super().__init__(socket_path, CmdHandler)
         self.config_path = config_path
         self.socket_path = socket_path
         self.log_path = log_path
@@ -106,13 +186,28 @@ class Server(UnixStreamServer):
         self.logger = None
         self.configuration = None
         self.monitor = None
+        self._unix_server = None
+        self._stopped = None
+        self._handlers = set()
+        # Tasks serving client connections, cancelled on shutdown
+        self._connections = set()
+        # CmdHandlers which are streaming a response, cancelled on shutdown
+        self._streams = set()
+        # Subscribed writers and the write locks of their connections
+        self.subscribers = {}
+        self._event_writes = set()
+        # Reloads requested by SIGHUP
+        self._reloads = set()
+        self._profiling = False
+        # State passed from the daemon which re-executed into this one, and to the next one
+        self.handoff = None
+        # Duplicate of the listening socket kept for the re-executed daemon
+        self._listener_fd = None
 
     def startup(self):
         """Load the configuration and monitor."""
-        # Register cleanup functions and signal handlers
+        # Register cleanup functions
         atexit.register(clean_up, self.pid_path, self.socket_path)
-        signal.signal(signal.SIGTERM, self.stop_server)
-        signal.signal(signal.SIGHUP, self.reload)
 
         # setup logging
         try:
@@ -132,132 +227,464 @@ class Server(UnixStreamServer):
             self.logger.error(f"Configuration error: {e}")
             raise
         self.monitor = Monitor(self.configuration)
-        self.monitor.reload_config()
+        self.handoff = read_handoff()
+        if self.handoff is not None:
+            self.monitor.take_over(self.handoff["tasks"])
+            self.logger.info("Taking over from the previous daemon.")
 
         self.logger.info("Server startup succeeded.")
 
-    def service_actions(self):
-        """Update the status of programs."""
-        self.monitor.update()
+    async def serve_forever(self):
+        """Serve clients and supervise tasks on the event loop until stopped."""
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, self._stopped.set)
+        loop.add_signal_handler(signal.SIGHUP, self._reload_on_signal)
+
+        # Listen before autostarting, the children's fds must not keep the socket from being created.
+        if self.handoff is not None:
+            listener = socket.socket(fileno=self.handoff["socket_fd"])
+            self._unix_server = await asyncio.start_unix_server(self._accept, sock=listener, **UNIX_SERVER_OPTIONS)
+            self.handoff = None
+        else:
+            self._unix_server = await asyncio.start_unix_server(self._accept, path=self.socket_path,
+                                                                **UNIX_SERVER_OPTIONS)
+        self.logger.info(f"Serving on {self.socket_path}.")
+        await self.monitor.reload_config()
+        supervisor = loop.create_task(self.monitor.supervise())
+        sampler = loop.create_task(self.monitor.sample_resources())
+        health = loop.create_task(self.monitor.check_health())
+        settings = self.configuration.settings
+        metrics = MetricsServer(self.monitor.metrics)
+        try:
+            await metrics.start(settings.metrics_socket, settings.metrics_port)
+        except OSError as e:
+            self.logger.error(f"Failed to serve metrics: {e}")
+        try:
+            await self._stopped.wait()
+        finally:
+            self._unix_server.close()
+            await metrics.close()
+            if settings.metrics_socket:
+                clean_up(settings.metrics_socket)
+            # Let requests in flight receive their responses, e.g. stop_server's one.
+            for stream in list(self._streams):
+                stream.cancel()
+            if self._handlers:
+                await asyncio.wait(self._handlers, timeout=REQUEST_TIMEOUT)
+            # Since Python 3.12.1, wait_closed() also waits for the client connections to close.
+            for connection in list(self._connections):
+                connection.cancel()
+            if self._connections:
+                await asyncio.wait(self._connections)
+            await self._unix_server.wait_closed()
+            if self._listener_fd is not None:
+                os.set_inheritable(self._listener_fd, True)
+                self.handoff = {"socket_fd": self._listener_fd, "tasks": self.monitor.handoff()}
+            supervisor.cancel()
+            sampler.cancel()
+            health.cancel()
+            loop.remove_signal_handler(signal.SIGTERM)
+            loop.remove_signal_handler(signal.SIGHUP)
+            self.logger.info("Server stopped.")
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve requests of a client connection until the client closes it.
+
+        Every request is handled in its own task, so a client can pipeline
+        requests and match the responses by their id.
+        """
+        loop = asyncio.get_running_loop()
+        connection = asyncio.current_task()
+        self._connections.add(connection)
+        limiter = asyncio.Semaphore(MAX_PIPELINED)
+        # Responses are written by several handlers, raw data must not be interleaved.
+        write_lock = asyncio.Lock()
+        requests = {}
+
+        def _done(task):
+            requests.pop(task, None)
+            limiter.release()
+
+        try:
+            while True:
+                request = await read_frame(reader)
+                if request is None:
+                    break
+                if "cancel" in request:
+                    # Stop a streamed response of this connection, e.g. tail --follow.
+                    for handler in requests.values():
+                        if handler.request_id == request["cancel"]:
+                            handler.cancel()
+                    continue
+                await limiter.acquire()
+                handler = CmdHandler(self, writer, request, write_lock)
+                task = loop.create_task(handler.handle())
+                requests[task] = handler
+                task.add_done_callback(_done)
+        except (ConnectionError, ProtocolError) as e:
+            self.logger.debug(f"Client connection error: {e!r}")
+        finally:
+            for handler in list(requests.values()):
+                handler.cancel()
+            if requests:
+                await asyncio.wait(requests)
+            self.subscribers.pop(writer, None)
+            writer.close()
+            self._connections.discard(connection)
+
+    def _publish(self, event: dict):
+        """Push an event to all subscribed clients."""
+        frame = encode_frame(event)
+        for writer, write_lock in list(self.subscribers.items()):
+            if writer.is_closing():
+                del self.subscribers[writer]
+                continue
+            if not write_lock.locked():
+                writer.write(frame)
+                continue
+            # A response is being written, queue the event behind it.
+            write = asyncio.get_running_loop().create_task(self._write_event(writer, write_lock, frame))
+            self._event_writes.add(write)
+            write.add_done_callback(self._event_writes.discard)
+
+    @staticmethod
+    async def _write_event(writer: asyncio.StreamWriter, write_lock: asyncio.Lock, frame: bytes):
+        async with write_lock:
+            if not writer.is_closing():
+                writer.write(frame)
 
     @classmethod
     def start_in_background(cls, *args, **kwargs):
         """Start the server in the background."""
+        if REEXEC_ENV in os.environ:
+            # Executed by reexec, the daemon is already detached.
+            cls.run(*args, **kwargs)
+            return
         # Child process.
         with DaemonContext(working_directory=os.path.curdir):
-            with cls(*args, **kwargs) as server:
-                server.startup()
-                server.serve_forever()
+            cls.run(*args, **kwargs)
+
+    @classmethod
+    def run(cls, *args, **kwargs):
+        """Serve until stopped, then execute a new daemon if reexec was requested."""
+        server = cls(*args, **kwargs)
+        server.startup()
+        asyncio.run(server.serve_forever())
+        if server.handoff is not None:
+            server.exec_handoff()
+
+    def exec_handoff(self):
+        """Execute the daemon again in this process, passing it the handoff state.
+
+        The process keeps its pid, so the tasks stay its children. atexit
+        handlers don't run, the socket and pid files stay in place.
+        """
+        state = tempfile.TemporaryFile("w+")
+        json.dump(self.handoff, state)
+        state.flush()
+        state.seek(0)
+        os.set_inheritable(state.fileno(), True)
+        env = dict(os.environ, **{REEXEC_ENV: str(state.fileno())})
+        self.logger.info("Re-executing the server.")
+        logging.shutdown()
+        os.execve(sys.executable, sys.orig_argv, env)
 
     # Server commands which can be sent via the socket
 
-    def start(self, tasks: list[str], all_tasks=False):
+    async def start(self, tasks: list[str], all_tasks=False):
         """Start tasks."""
-        msg = ""
-        fail_cnt = 0
         if all_tasks:
-            tasks = [name for name in self.monitor.active_tasks if self.monitor.tasks[name].is_idle()]
+            tasks = list(self.monitor.by_state[State.CREATED])
+        tasks, errors = self.monitor.expand_names(tasks)
+        total = len(tasks) + len(errors)
         self.logger.debug(f"Starting tasks: {tasks}")
-        for name in tasks:
-            try:
-                self.monitor.start_by_name(name)
-            except MonitorError as e:
-                msg += f"  {e}\n"
-                fail_cnt += 1
+        errors += await self.monitor.bulk(self.monitor.start_by_name, tasks)
+        msg = "".join(f"  {e}\n" for e in errors)
+        fail_cnt = len(errors)
         if fail_cnt:
-            msg = f"Failed to start {fail_cnt} out of {len(tasks)} tasks:\n" + msg
+            msg = f"Failed to start {fail_cnt} out of {total} tasks:\n" + msg
             return 2, msg
-        msg = f"All {len(tasks)} tasks started successfully"
+        msg = f"All {total} tasks started successfully"
         return 0, msg
 
-    def stop(self, tasks: list[str], all_tasks=False):
+    async def stop(self, tasks: list[str], all_tasks=False):
         """Stop tasks."""
-        msg = ""
-        fail_cnt = 0
         if all_tasks:
-            tasks = [name for name in self.monitor.active_tasks if self.monitor.tasks[name].status != "STOPPING"]
+            tasks = list(self.monitor.names_in_states(
+                State.CREATED, State.STARTING, State.RUNNING, State.BACKOFF))
+        tasks, errors = self.monitor.expand_names(tasks)
+        total = len(tasks) + len(errors)
         self.logger.debug(f"Stopping tasks: {tasks}")
-        for name in tasks:
-            try:
-                self.monitor.stop_by_name(name)
-            except MonitorError as e:
-                msg += f"  {e}\n"
-                fail_cnt += 1
+        errors += await self.monitor.bulk(self.monitor.stop_by_name, tasks)
+        msg = "".join(f"  {e}\n" for e in errors)
+        fail_cnt = len(errors)
         if fail_cnt:
-            msg = f"Failed to stop {fail_cnt} out of {len(tasks)} tasks:\n" + msg
+            msg = f"Failed to stop {fail_cnt} out of {total} tasks:\n" + msg
             return 2, msg
-        msg = f"All {len(tasks)} tasks stopped successfully"
+        msg = f"All {total} tasks stopped successfully"
         return 0, msg
 
-    def restart(self, tasks: list[str], all_tasks=False):
+    async def restart(self, tasks: list[str], all_tasks=False):
         """Restart tasks."""
-        msg = ""
-        fail_cnt = 0
         if all_tasks:
             tasks = [name for name, task in self.monitor.tasks.items() if task.rebooting is False]
+        tasks, errors = self.monitor.expand_names(tasks)
+        total = len(tasks) + len(errors)
         self.logger.debug(f"Restarting tasks: {tasks}")
-        for name in tasks:
-            try:
-                self.monitor.restart_by_name(name)
-            except MonitorError as e:
-                msg += f"  {e}\n"
-                fail_cnt += 1
+        errors += await self.monitor.bulk(self.monitor.restart_by_name, tasks)
+        msg = "".join(f"  {e}\n" for e in errors)
+        fail_cnt = len(errors)
         if fail_cnt:
-            msg = f"Failed to restart {fail_cnt} out of {len(tasks)} tasks:\n" + msg
+            msg = f"Failed to restart {fail_cnt} out of {total} tasks:\n" + msg
             return 2, msg
-        msg = f"All {len(tasks)} tasks restarted successfully"
+        msg = f"All {total} tasks restarted successfully"
         return 0, msg
 
-    def stop_server(self, signum=None, frame=None):
+    async def stop_server(self):
         """Stop the server."""
         self.logger.debug("Stopping server.")
-        def _stop():
-            """Actually stop the server."""
-            self.shutdown()  # look shutdown method in parent server class
-
-        threading.Thread(target=_stop).start()  # Check shutdown method in base class
+        self._stopped.set()
         return 0, "Server has been stopped"
 
-    def reload(self, signum=None, frame=None):
+    async def reexec(self):
+        """Replace the server with a fresh process, keeping the socket and the tasks."""
+        if self.monitor.spawning or self.monitor.old_tasks:
+            return 1, "Tasks are being started or retired, try again later"
+        self.logger.debug("Re-executing server.")
+        # Stop accepting right away, new connections queue on the socket until the new daemon accepts them.
+        self._listener_fd = os.dup(self._unix_server.sockets[0].fileno())
+        self._unix_server.close()
+        self._stopped.set()
+        return 0, "Server is being re-executed"
+
+    def _reload_on_signal(self):
+        reload = asyncio.get_running_loop().create_task(self._signal_reload())
+        self._reloads.add(reload)
+        reload.add_done_callback(self._reloads.discard)
+
+    async def _signal_reload(self):
+        status, msg = await self.reload()
+        if status:
+            self.logger.error(f"Reload on SIGHUP failed: {msg}")
+
+    async def reload(self):
         """Reload the configuration."""
         self.logger.debug("Reloading configuration.")
         try:
-            self.monitor.reload_config()
+            await self.monitor.reload_config()
         except ConfigurationError as e:
             return 1, f"Configuration error: {e}"
         except Exception as e:
             return 1, f"Some error {e}"
+        self._publish({"event": "tasks", **self._service_get_tasks()})
         return 0, "Configuration has been reloaded"
 
-    def status(self, tasks=()):
+    async def status(self, tasks=(), groups=False, watch=False, json=False, fields=None, state=None):
         """Show the status of programs."""
+        await self.monitor.request_stats()
+        if json or fields is not None or state is not None:
+            if watch or groups:
+                return 1, "--json can't be combined with --watch or --groups"
+            return self._status_json(tasks, fields, state)
+        status, status_msg = self._status_table(tasks, groups)
+        if watch:
+            return status, self._watch_status(tasks, groups)
+        return status, status_msg
+
+    async def _watch_status(self, tasks, groups):
+        """Yield the status table again after every resource sample."""
+        while True:
+            _, table = self._status_table(tasks, groups)
+            chunk = [CLEAR_SCREEN]
+            size = 0
+            for line in table:
+                chunk.append(line)
+                size += len(line)
+                if size >= CHUNK_SIZE:
+                    yield "".join(chunk)
+                    chunk = []
+                    size = 0
+            yield "".join(chunk)
+            self.monitor.want_stats()
+            await self.monitor.wait_sample()
+
+    def _status_table(self, tasks=(), groups=False):
+        """Return the status and the line iterator of the status table."""
         fail_cnt = 0
         err_msg = ""
-        if tasks:
-            tasks_dict = {}
+        group_rows = []
+        if groups:
+            group_rows = sorted(self.monitor.by_group)
+            names = []
+        elif tasks:
+            names = []
             for name in tasks:
-                try:
-                    tasks_dict[name] = self.monitor.get_task_by_name(name)
-                except MonitorError as e:
-                    err_msg += f"{e}\n"
+                if ":" not in name and name not in self.monitor.tasks and name in self.monitor.by_group:
+                    # A bare program name shows one aggregated row.
+                    group_rows.append(name)
+                    continue
+                expanded, errors = self.monitor.expand_names([name])
+                for error in errors:
+                    err_msg += f"{error}\n"
                     fail_cnt += 1
-            tasks = tasks_dict
+                for name in expanded:
+                    try:
+                        self.monitor.get_task_by_name(name)
+                        names.append(name)
+                    except MonitorError as e:
+                        err_msg += f"{e}\n"
+                        fail_cnt += 1
         else:
-            tasks = self.monitor.tasks
-        self.logger.debug(f"Getting status for tasks: {tasks}")
-        status_msg = Monitor.format_tasks_status(tasks) if tasks else "No tasks found\n"
+            names = None
+        self.logger.debug(f"Getting status for tasks: {names or 'all'}, groups: {group_rows}")
+        if (names == [] and not group_rows) or not self.monitor.tasks:
+            status_msg = iter(["No tasks found\n"])
+        else:
+            status_msg = Monitor.iter_tasks_status(self.monitor.iter_sorted_tasks(names), self.monitor.sampler.stats)
+            if group_rows:
+                group_lines = (self.monitor.format_group_line(group) for group in sorted(set(group_rows))
+                               if group in self.monitor.by_group)
+                status_msg = itertools.chain(status_msg, group_lines)
         if fail_cnt:
-            return 2, status_msg + f"\n{err_msg}"
+            return 2, itertools.chain(status_msg, [f"\n{err_msg}"])
         return 0, status_msg
 
-    def _service_get_tasks(self):
-        return {"tasks": list(self.monitor.tasks.keys())}
+    def _status_json(self, tasks, fields, state):
+        """Return the status and an iterator of JSON lines, serialized while they are sent."""
+        try:
+            fields, states = self._status_filters(fields, state)
+        except ValueError as e:
+            return 1, f"{e}"
+        names, errors = self._status_names(tasks)
+        if errors:
+            return 1, "".join(f"{error}\n" for error in errors)
+        records = self.monitor.iter_status_records(names, states, None, fields)
+        return 0, (json.dumps(record, separators=(",", ":")) + "\n" for _, record in records)
+
+    @staticmethod
+    def _status_filters(fields, states) -> tuple:
+        """Validate field and state lists, given as lists or comma separated strings."""
+        if isinstance(fields, str):
+            fields = fields.split(",")
+        if isinstance(states, str):
+            states = states.split(",")
+        if fields is not None:
+            if not isinstance(fields, list) or not all(isinstance(field, str) and field in STATUS_FIELDS for field in fields):
+                raise ValueError(f"Invalid status fields: {fields}, available: {', '.join(STATUS_FIELDS)}")
+        if states is not None:
+            if not isinstance(states, list) or not all(isinstance(state, str) and state in State.__members__ for state in states):
+                raise ValueError(f"Invalid states: {states}, available: {', '.join(State.__members__)}")
+            states = {State[state] for state in states}
+        return fields, states
+
+    def _status_names(self, tasks) -> tuple:
+        """Resolve the task list of a JSON status, None for all tasks. Returns (names, errors)."""
+        if not tasks:
+            return None, []
+        names, errors = self.monitor.expand_names(tasks)
+        known = []
+        for name in names:
+            try:
+                self.monitor.get_task_by_name(name)
+                known.append(name)
+            except MonitorError as e:
+                errors.append(e)
+        return known, errors
+
+    async def tail(self, tasks: list[str], follow=False, stderr=False):
+        """Stream the output of a task."""
+        stream = "stderr" if stderr else "stdout"
+        try:
+            output = self.monitor.tail_output(tasks[0], stream, follow)
+        except MonitorError as e:
+            return 1, f"{e}"
+        self.logger.debug(f"Tailing {stream} of '{tasks[0]}', follow: {follow}")
+        return 0, output
+
+    async def profile(self, args: list[str]):
+        """Profile the event loop thread with cProfile for some seconds."""
+        try:
+            seconds = float(args[0])
+        except ValueError:
+            return 1, f"Invalid number of seconds: {args[0]}"
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            return 1, f"Profile time must be from 0 to {MAX_PROFILE_SECONDS} seconds"
+        if self._profiling:
+            return 1, "The daemon is already being profiled"
+        self.logger.info(f"Profiling for {seconds}s.")
+        self._profiling = True
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            self._profiling = False
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_LINES)
+        return 0, iter(report.getvalue().splitlines(keepends=True))
+
+    def _service_get_tasks(self, handler=None):
+        return {"tasks": list(self.monitor.tasks.keys()), "groups": list(self.monitor.by_group)}
+
+    def _service_get_status(self, handler):
+        """One page of status records.
+
+        Request keys, all optional: tasks, groups, states and fields lists,
+        limit, and the cursor returned with the previous page. The response
+        has the "tasks" records and the "cursor" of the next page, None after
+        the last one.
+        """
+        request = handler.request
+        # The first page after a while without status requests has no resource usage yet.
+        self.monitor.want_stats()
+        limit = request.get("limit", STATUS_PAGE_SIZE)
+        if not isinstance(limit, int) or not 0 < limit <= MAX_STATUS_PAGE_SIZE:
+            return {"status": 1, "msg": f"limit must be from 1 to {MAX_STATUS_PAGE_SIZE}"}
+        for key in ("tasks", "groups"):
+            value = request.get(key)
+            if value is not None and not (isinstance(value, list) and all(isinstance(v, str) for v in value)):
+                return {"status": 1, "msg": f"{key} must be a list of names"}
+        cursor = request.get("cursor")
+        if cursor is not None and not isinstance(cursor, str):
+            return {"status": 1, "msg": "cursor must be the cursor of the previous page"}
+        try:
+            fields, states = self._status_filters(request.get("fields"), request.get("states"))
+        except ValueError as e:
+            return {"status": 1, "msg": f"{e}"}
+        names, errors = self._status_names(request.get("tasks"))
+        if errors:
+            return {"status": 1, "msg": "".join(f"{error}\n" for error in errors)}
+        groups = request.get("groups")
+        records = self.monitor.iter_status_records(names, states, set(groups) if groups else None,
+                                                   fields, cursor)
+        page = list(itertools.islice(records, limit + 1))
+        cursor = page[limit - 1][0] if len(page) > limit else None
+        return {"tasks": [record for _, record in page[:limit]], "cursor": cursor}
+
+    def _service_subscribe_tasks(self, handler):
+        """Get the task list and push it to the client whenever it changes."""
+        self.subscribers[handler.writer] = handler.write_lock
+        return self._service_get_tasks()
 
 
-class CmdHandler(StreamRequestHandler):
+class CmdHandler:
 
     logger = logging.getLogger("CmdHandler")
 
+    def __init__(self, server: Server, writer: asyncio.StreamWriter, request: dict,
+                 write_lock: asyncio.Lock = None):
+        self.server = server
+        self.writer = writer
+        self.request = request
+        self.request_id = request.get("id")
+        self.write_lock = write_lock or asyncio.Lock()
+        self.task = None
+        self.cancelled = False
+        # Set while a streamed response waits for its next part, the only safe point to cancel
+        self._waiting = False
+
     @staticmethod
     def format_help(cmd):
         if cmd == "help":
@@ -267,11 +694,14 @@ class CmdHandler(StreamRequestHandler):
                 msg += f"  {cmd:<11}  {info['help']}\n"
             return msg
         cmd_info = Server.commands_info[cmd]
+        short_options = {long: short for short, long in cmd_info.get("short_options", {}).items()}
         msg = Server.commands_info[cmd].get("usage", f"Usage: {cmd} [option]\n\n"
                                                      f"{cmd_info['help']}\n")
         msg += "\nOptions:\n"
         for opt in cmd_info["options"]:
-            msg += f"  --{opt:<4}  {Server.options_info[opt]}\n"
+            opt = opt.rstrip("=")
+            short = f", -{short_options[opt]}" if opt in short_options else ""
+            msg += f"  --{opt:<6}  {Server.options_info[opt]}{short}\n"
         return msg
 
     @staticmethod
@@ -282,68 +712,207 @@ class CmdHandler(StreamRequestHandler):
         if cmd not in Server.commands_info:
             raise ValueError(f"Parser: Unknown command '{cmd}'")
         arg_tokens = tokens[1:] if len(tokens) > 1 else []
-        cmd_options = Server.commands_info[cmd].get("options", [])
+        cmd_info = Server.commands_info[cmd]
+        cmd_options = cmd_info.get("options", [])
+        short_options = cmd_info.get("short_options", {})
         try:
-            opts, args = getopt.getopt(arg_tokens, "", cmd_options)
+            opts, args = getopt.gnu_getopt(arg_tokens, "".join(short_options), cmd_options)
         except getopt.GetoptError as e:
             raise ValueError(f"Parser: {e}")
-        cmd_args = Server.commands_info[cmd].get("args", None)
+        # Flags are passed as keyword arguments, other options replace the task list.
+        kwargs = {}
+        options = []
+        for option, value in opts:
+            option = option.lstrip("-")
+            option = short_options.get(option, option)
+            if option in cmd_info.get("flags", []):
+                kwargs[option] = True
+            elif option in cmd_info.get("values", []):
+                kwargs[option] = value
+            else:
+                options.append(option)
+        cmd_args = cmd_info.get("args", None)
         if args:
             if cmd_args is None:
                 raise ValueError(f"Parser: {cmd}: Doesn't accept any arguments")
-            if opts:
+            if options:
                 raise ValueError(f"Parser: {cmd}: Only task list or an option can be specified")
+            if cmd_args == "1" and len(args) > 1:
+                raise ValueError(f"Parser: {cmd}: Only one argument can be specified")
             args = [args]
-        elif cmd_args == "+" and not opts:
+        elif cmd_args == "+" and not options:
             raise ValueError(f"Parser: {cmd}: Task list or an option expected")
-        elif len(opts) > 1:
+        elif cmd_args == "1" and not options:
+            raise ValueError(f"Parser: {cmd}: One argument expected")
+        elif len(options) > 1:
             raise ValueError(f"Parser: {cmd}: Only one option can be provided")
         help_on = False
-        for option, value in opts:
-            if option == "--all":
+        for option in options:
+            if option in ("all", "groups"):
                 args = [[], True]
-            elif option == "--help":
+            elif option == "help":
                 help_on = True
             else:
-                raise ValueError(f"Parser: {cmd}: Unknown option '{option}'")
-        return cmd, args, help_on
-
-    def send_response(self, msg, status: int, cmd=None):
-        response = {"msg": f"{msg}", "status": status, "command": f"{cmd}"}
-        self.wfile.write(json.dumps(response).encode(MSG_ENCODING))
-
-    def _handle_service(self, service_name):
+                raise ValueError(f"Parser: {cmd}: Unknown option '--{option}'")
+        return cmd, args, kwargs, help_on
+
+    async def send_response(self, msg, status: int, cmd=None):
+        """Send the response. Iterators of strings are streamed in chunks.
+
+        Async iterators are streamed part by part until they end or the
+        request is cancelled.
+        """
+        if isinstance(msg, Iterator):
+            msg = await self._send_chunks(msg)
+        elif isinstance(msg, AsyncIterator):
+            await self._send_stream(msg)
+            msg = ""
+        elif isinstance(msg, str) and len(msg) > CHUNK_SIZE:
+            msg = await self._send_chunks(iter([msg]))
+        response = {"msg": f"{msg}".rstrip(), "status": status, "command": f"{cmd}"}
+        await self._write(response)
+
+    async def _send_chunks(self, parts):
+        """Send parts in frames of CHUNK_SIZE characters marked with "more", return the tail.
+
+        Parts are joined and split, so a long part can't exceed the frame size.
+        """
+        chunk = []
+        size = 0
+        for part in parts:
+            chunk.append(part)
+            size += len(part)
+            if size >= CHUNK_SIZE:
+                text = "".join(chunk)
+                end = len(text) - len(text) % CHUNK_SIZE
+                for start in range(0, end, CHUNK_SIZE):
+                    await self._write({"msg": text[start:start + CHUNK_SIZE], "more": True})
+                chunk = [text[end:]]
+                size = len(chunk[0])
+        return "".join(chunk)
+
+    async def _send_stream(self, parts: AsyncIterator):
+        """Send str, bytes and FileSegment parts as they come."""
+        self.server._streams.add(self)
+        try:
+            while not self.cancelled:
+                self._waiting = True
+                try:
+                    part = await anext(parts)
+                except StopAsyncIteration:
+                    break
+                except asyncio.CancelledError:
+                    if not self.cancelled:
+                        raise
+                    asyncio.current_task().uncancel()
+                    break
+                finally:
+                    self._waiting = False
+                if isinstance(part, FileSegment):
+                    await self._send_file(part)
+                elif isinstance(part, bytes):
+                    for start in range(0, len(part), MAX_FRAME_SIZE):
+                        await self._write({"more": True}, part[start:start + MAX_FRAME_SIZE])
+                else:
+                    tail = await self._send_chunks(iter([part]))
+                    if tail:
+                        await self._write({"msg": tail, "more": True})
+        finally:
+            self.server._streams.discard(self)
+            await parts.aclose()
+
+    async def _send_file(self, segment: FileSegment):
+        """Send a part of a file as raw frames, using sendfile where the transport supports it."""
+        try:
+            file = open(segment.path, "rb")
+        except OSError as e:
+            self.logger.debug(f"CmdHandler: Failed to open {segment.path}: {e}")
+            return
+        loop = asyncio.get_running_loop()
+        with file:
+            # The file may have been rotated in the meantime.
+            end = min(segment.offset + segment.count, os.fstat(file.fileno()).st_size)
+            offset = segment.offset
+            while offset < end:
+                count = min(end - offset, MAX_FRAME_SIZE)
+                async with self.write_lock:
+                    self._write_header({"more": True, RAW_KEY: count})
+                    await loop.sendfile(self.writer.transport, file, offset, count)
+                offset += count
+
+    def _write_header(self, message: dict):
+        if self.request_id is not None:
+            message["id"] = self.request_id
+        self.writer.write(encode_frame(message))
+
+    async def _write(self, message: dict, data: bytes = None):
+        """Write a frame, followed by raw data if given."""
+        async with self.write_lock:
+            if data is not None:
+                message[RAW_KEY] = len(data)
+            self._write_header(message)
+            if data is not None:
+                self.writer.write(data)
+            # Wait for the client to consume the data, so buffers stay bounded.
+            await self.writer.drain()
+
+    def cancel(self):
+        """Stop the streamed response, the final frame is still sent."""
+        if self in self.server._streams and not self.cancelled:
+            self.cancelled = True
+            if self._waiting and self.task is not None:
+                self.task.cancel()
+
+    async def _handle_service(self, service_name):
         self.logger.debug(f"CmdHandler: Service action '{service_name}' requested")
         cmd = getattr(self.server, service_name, None)
         if cmd is None:
             self.logger.debug(f"CmdHandler: Service {service_name} does not exist")
-            return
+            return await self.send_response(f"CmdHandler: Service {service_name} does not exist", 1)
         try:
-            self.wfile.write(json.dumps(cmd()).encode(MSG_ENCODING))
+            response = cmd(self)
         except Exception as e:
-            self.logger.debug(f"CmdHandler: Service {service_name} error: {e}")
+            self.logger.error(f"CmdHandler: Service {service_name} error: {e!r}")
+            response = {"status": 1, "msg": f"Service {service_name} failed: {e}"}
+        await self._write(response)
 
-    def handle(self):
-        data = self.request.recv(BUFFER_SIZE).decode(MSG_ENCODING)
+    async def handle(self):
+        handler = self.task = asyncio.current_task()
+        self.server._handlers.add(handler)
+        try:
+            await self._dispatch(f"{self.request.get('cmd', '')}")
+        except ProtocolError as e:
+            # A frame which can't be encoded isn't written at all, the client still gets a final one.
+            self.logger.error(f"CmdHandler: Failed to encode response: {e}")
+            try:
+                await self._write({"msg": f"Failed to send the response: {e}", "status": 1})
+            except ConnectionError as e:
+                self.logger.debug(f"CmdHandler: Failed to send response: {e!r}")
+        except ConnectionError as e:
+            self.logger.debug(f"CmdHandler: Failed to send response: {e!r}")
+        finally:
+            self.server._handlers.discard(handler)
+
+    async def _dispatch(self, data):
         if data in Server.service_api:
-            return self._handle_service(data)
+            return await self._handle_service(data)
         try:
-            cmd_name, args, help_on = self.parse_args(shlex.split(data))
-            self.logger.debug(f"CmdHandler: received command '{cmd_name}' with args: {args} help: '{help_on}'")
+            cmd_name, args, kwargs, help_on = self.parse_args(shlex.split(data))
+            self.logger.debug(f"CmdHandler: received command '{cmd_name}' with args: {args} {kwargs} help: '{help_on}'")
         except ValueError as e:
-            return self.send_response(e, 1)
+            return await self.send_response(e, 1)
         except Exception as e:
-            return self.send_response(f"CmdHandler: Unknown exception: {e}", 1)
+            return await self.send_response(f"CmdHandler: Unknown exception: {e}", 1)
 
         if help_on or cmd_name == "help":
-            return self.send_response(self.format_help(cmd_name), 0)
+            return await self.send_response(self.format_help(cmd_name), 0)
 
         cmd = getattr(self.server, cmd_name, None)
         if cmd is None:
-            return self.send_response(f"CmdHandler: '{cmd_name}' command not found", 1)
+            return await self.send_response(f"CmdHandler: '{cmd_name}' command not found", 1)
 
         try:
-            status, message = cmd(*args)
-            self.send_response(message.rstrip(), status, cmd_name)
+            status, message = await cmd(*args, **kwargs)
         except Exception as e:
-            self.send_response(f"CmdHandler: {cmd_name}: Unknown exception: {e}", 1, cmd_name)
+            return await self.send_response(f"CmdHandler: {cmd_name}: Unknown exception: {e}", 1, cmd_name)
+        await self.send_response(message, status, cmd_name)
@@ -1,10 +1,10 @@
 import time
-import socket
 import readline
-import json
+import signal
 import sys
 
-from server import BUFFER_SIZE, MSG_ENCODING
+from client import Session, SocketError
+from protocol import ProtocolError
 from server import Server
 
 RED_COLOR = "\033[31m"
@@ -18,8 +18,8 @@ class Completer:
         self.commands = Server.commands_info
         self.tasks = []
 
-    def update_tasks(self, tasks: list):
-        self.tasks = tasks
+    def update_tasks(self, tasks: list, groups: list = ()):
+        self.tasks = tasks + [f"{group}:*" for group in groups]
 
     def complete(self, text, state):
         tokens = readline.get_line_buffer().split()
@@ -35,15 +35,11 @@ class Completer:
         except IndexError:
             return None
 
-class SocketError(Exception):
-    def __init__(self, message):
-        self.message = message
-        super().__init__(f"Socket error: {self.message}")
-
 class Shell:
 
     def __init__(self, sock_file: str):
         self.sock_file = sock_file
+        self.session = Session(sock_file, on_event=self._on_event, on_connect=self._subscribe)
         self.completer = Completer()
         readline.parse_and_bind("tab: complete")
         readline.set_completer(self.completer.complete)
@@ -51,25 +47,32 @@ class Shell:
         print(f"Taskmaster shell initiated on {sock_file}")
 
 
-    def _update_tasks(self):
+    def _subscribe(self, session: Session):
+        """Get the task list and its further changes over the new connection."""
         try:
-            data = self._send_request("_service_get_tasks")
-            response = json.loads(data.decode(MSG_ENCODING))
-            self.completer.update_tasks(response.get("tasks", []))
+            for response in session.request("_service_subscribe_tasks"):
+                self.completer.update_tasks(response.get("tasks", []), response.get("groups", []))
         except Exception as e:
             print_err(f"Shell: update_tasks service error: {e}")
 
+    def _on_event(self, event: dict):
+        if event.get("event") == "tasks":
+            self.completer.update_tasks(event.get("tasks", []), event.get("groups", []))
+
     def run(self):
         time.sleep(1) # Wait for the server to init
-        self._update_tasks()
+        try:
+            self.session.connect()
+        except SocketError as e:
+            print_err(f"Shell: {e}")
         while True:
+            self.session.poll_events()
             cmd_input = self._input("tm> ")
             if cmd_input == "exit":
                 print("\nExiting shell...")
                 break
             try:
-                data = self._send_request(cmd_input)
-                response = json.loads(data.decode(MSG_ENCODING))
+                response = self._receive(self.session.send(cmd_input))
                 status = response.get("status", None)
                 msg = response.get("msg", None)
                 cmd = response.get("command", None)
@@ -80,8 +83,9 @@ class Shell:
                         print(msg)
                     if cmd == "stop_server":
                         break
-                    elif cmd == "reload":
-                        self._update_tasks()
+                    if cmd == "reexec":
+                        # The new daemon accepts a new connection.
+                        self.session.close()
                 elif status == 1:
                     print_err(f"Daemon: {msg}")
                 elif status == 2:
@@ -91,20 +95,34 @@ class Shell:
 
             except SocketError as e:
                 print_err(f"Shell: {e}")
-            except (AssertionError, UnicodeDecodeError, json.JSONDecodeError) as e:
+            except (AssertionError, ProtocolError) as e:
                 print_err(f"Shell: Response error: {e}")
             except Exception as e:
                 print_err(f"Shell: Unknown error: {e}")
 
 
-    def _send_request(self, request: str):
+    def _receive(self, request_id: int) -> dict:
+        """Print streamed parts of the response and return its last frame.
+
+        Ctrl-C cancels a streamed response instead of exiting the shell.
+        """
+        def _cancel(signum, frame):
+            self.session.cancel(request_id)
+
+        previous = signal.signal(signal.SIGINT, _cancel)
         try:
-            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
-                s.connect(self.sock_file)
-                s.sendall(request.encode(MSG_ENCODING))
-                return s.recv(BUFFER_SIZE, )
-        except (FileNotFoundError, ConnectionError, socket.timeout, socket.gaierror) as e:
-            raise SocketError(e)
+            for response in self.session.responses(request_id):
+                if not response.get("more"):
+                    return response
+                # Streamed part of a long message, the last frame holds the status.
+                if "data" in response:
+                    sys.stdout.flush()
+                    sys.stdout.buffer.write(response["data"])
+                    sys.stdout.buffer.flush()
+                else:
+                    print(response.get("msg", ""), end="")
+        finally:
+            signal.signal(signal.SIGINT, previous)
 
     @staticmethod
     def _input(prompt):
@@ -0,0 +1,169 @@
+import asyncio
+import functools
+import itertools
+import logging
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from configuration import Program, Settings
+from procstats import read_starttime
+
+SPAWN_OUTPUT_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+SPAWN_OUTPUT_MODE = 0o666
+
+
+class SpawnedProcess:
+    """Popen-like handle of a child process started without subprocess."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.returncode = None
+
+    def __repr__(self):
+        return f"<SpawnedProcess: pid: {self.pid} returncode: {self.returncode}>"
+
+    def poll(self):
+        if self.returncode is None:
+            self._wait(os.WNOHANG)
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            self._wait(0)
+        return self.returncode
+
+    def _wait(self, options: int):
+        try:
+            pid, status = os.waitpid(self.pid, options)
+        except ChildProcessError:
+            # Somebody else reaped it, the exit code is lost like in Popen.
+            self.returncode = 0
+            return
+        if pid == self.pid:
+            self.returncode = os.waitstatus_to_exitcode(status)
+
+    def send_signal(self, sig: int):
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class AdoptedProcess(SpawnedProcess):
+    """Handle of a process started by a previous daemon.
+
+    Unless the daemon was re-executed in place, the process isn't our child
+    any more: it is identified by pid and start time, and its exit code is
+    lost and reported as LOST_EXIT_CODE, which is never an expected one.
+    """
+
+    WAIT_INTERVAL = 0.01
+    # Out of the range of exit codes, so a configuration can't list it in exitcodes
+    LOST_EXIT_CODE = 256
+
+    def __init__(self, pid: int, starttime: int):
+        super().__init__(pid)
+        self.starttime = starttime
+
+    def _wait(self, options: int):
+        try:
+            pid, status = os.waitpid(self.pid, options)
+        except ChildProcessError:
+            if read_starttime(self.pid) != self.starttime:
+                self.returncode = self.LOST_EXIT_CODE
+            elif not options & os.WNOHANG:
+                time.sleep(self.WAIT_INTERVAL)
+            return
+        if pid == self.pid:
+            self.returncode = os.waitstatus_to_exitcode(status)
+
+
+def can_posix_spawn(program: Program) -> bool:
+    """os.posix_spawn has no file actions for changing cwd or umask."""
+    return hasattr(os, "posix_spawnp") and not program.cwd and program.umask == -1
+
+
+def open_capture_pipes() -> tuple:
+    """Create output pipes of a captured program.
+
+    Returns the read ends for the daemon and the write ends for the child,
+    both as {"stdout": fd, "stderr": fd}. The write ends must be closed by
+    the parent once the child is started.
+    """
+    read_ends, write_ends = {}, {}
+    try:
+        for stream in ("stdout", "stderr"):
+            read_ends[stream], write_ends[stream] = os.pipe()
+    except OSError:
+        for fd in itertools.chain(read_ends.values(), write_ends.values()):
+            os.close(fd)
+        raise
+    return read_ends, write_ends
+
+
+def posix_spawn_process(program: Program, pipes: dict = None) -> SpawnedProcess:
+    """Start the program with posix_spawn, redirecting output like Popen would.
+
+    pipes are write ends of capture pipes to use instead of the output files.
+    """
+    pipes = pipes or {}
+    file_actions = []
+    for fd, stream in ((1, "stdout"), (2, "stderr")):
+        if stream in pipes:
+            file_actions.append((os.POSIX_SPAWN_DUP2, pipes[stream], fd))
+        elif getattr(program, stream):
+            file_actions.append((os.POSIX_SPAWN_OPEN, fd, getattr(program, stream),
+                                 SPAWN_OUTPUT_FLAGS, SPAWN_OUTPUT_MODE))
+    args = program.args
+    env = program.env if program.env is not None else os.environ
+    # Python ignores these signals, Popen restores their defaults in the child with restore_signals.
+    pid = os.posix_spawnp(args[0], args, env, file_actions=file_actions,
+                          setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+    return SpawnedProcess(pid)
+
+
+class Spawner:
+    """Start tasks in worker threads with bounded concurrency and spawn rate.
+
+    Creating a process blocks in fork/exec and file opens, so it runs in a
+    thread pool of spawn_concurrency workers instead of on the event loop. Spawns
+    are additionally spaced out to spawn_rate per second. Both queues are
+    FIFO, so tasks start in the order spawn() was called.
+    """
+
+    def __init__(self, settings: Settings):
+        self.concurrency = settings.spawn_concurrency
+        self.rate = settings.spawn_rate
+        self.backend = settings.spawn_backend
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="spawn")
+        self._next_slot = 0.0
+        self.logger = logging.getLogger("Monitor")
+
+    def configure(self, settings: Settings):
+        """Apply changed settings. Spawns which are already queued are not affected."""
+        self.rate = settings.spawn_rate
+        self.backend = settings.spawn_backend
+        if settings.spawn_concurrency != self.concurrency:
+            self.logger.info(f"Spawn concurrency changed to {settings.spawn_concurrency}.")
+            self.executor.shutdown(wait=False)
+            self.concurrency = settings.spawn_concurrency
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="spawn")
+
+    async def spawn(self, task):
+        """Start the task as soon as the rate limit and a free worker allow."""
+        if self.rate:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + 1 / self.rate
+            if slot > now:
+                await asyncio.sleep(slot - now)
+        create = functools.partial(task.create_process, self.backend)
+        process, pipes = await asyncio.get_running_loop().run_in_executor(self.executor, create)
+        # The task itself is only changed on the loop thread.
+        task.started(process, pipes)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -3,7 +3,7 @@ import argparse
 import os
 import sys
 
-from server import Server
+from server import REEXEC_ENV, Server
 from shell import Shell
 
 
@@ -44,12 +44,14 @@ def validate_args(args: argparse.Namespace):
             log_path = os.path.abspath(args.log_config)
 
         pid_path = os.path.abspath(args.pid)
-        if os.path.exists(pid_path):
+        # A re-executed daemon takes over the files of the one it replaces.
+        reexec = REEXEC_ENV in os.environ
+        if os.path.exists(pid_path) and not reexec:
             print(
                 f"Pid file {pid_path} already exists. Taskmaster is already running. Exiting.")
             exit(1)
 
-        if os.path.exists(args.socket):
+        if os.path.exists(args.socket) and not reexec:
             print("Socket file already exists. Taskmaster is already running. Exiting.")
             sys.exit(1)
 
@@ -0,0 +1,127 @@
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from configuration import Program  # noqa: E402
+from limits import Cgroups, LimitError, apply_rlimits, parse_rlimits  # noqa: E402
+
+
+class ParseRlimitsTest(unittest.TestCase):
+
+    def test_single_value_sets_soft_and_hard(self):
+        self.assertEqual(parse_rlimits({"nofile": 1024}), {resource.RLIMIT_NOFILE: (1024, 1024)})
+
+    def test_soft_and_hard(self):
+        self.assertEqual(parse_rlimits({"NOFILE": [512, 1024]}), {resource.RLIMIT_NOFILE: (512, 1024)})
+
+    def test_unlimited(self):
+        infinity = resource.RLIM_INFINITY
+        for value in ("unlimited", "infinity", -1):
+            self.assertEqual(parse_rlimits({"as": value}), {resource.RLIMIT_AS: (infinity, infinity)})
+        self.assertEqual(parse_rlimits({"core": [0, "unlimited"]}), {resource.RLIMIT_CORE: (0, infinity)})
+
+    def test_invalid(self):
+        for rlimits in ({"files": 1}, {"nofile": [1, 2, 3]}, {"nofile": [1]}, {"nofile": -2},
+                        {"nofile": "1024"}, {"nofile": 1.5}):
+            with self.subTest(rlimits=rlimits), self.assertRaises(LimitError):
+                parse_rlimits(rlimits)
+
+
+class ApplyRlimitsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.process = subprocess.Popen(["sleep", "30"])
+
+    def tearDown(self):
+        self.process.kill()
+        self.process.wait()
+
+    def test_sets_limits_of_process(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        limits = (min(soft, 64), min(hard, 128))
+        apply_rlimits(self.process.pid, {resource.RLIMIT_NOFILE: limits})
+        self.assertEqual(resource.prlimit(self.process.pid, resource.RLIMIT_NOFILE), limits)
+
+    def test_failure(self):
+        with self.assertRaises(LimitError):
+            apply_rlimits(self.process.pid, {resource.RLIMIT_NOFILE: (128, 64)})
+        self.process.kill()
+        self.process.wait()
+        with self.assertRaises(LimitError):
+            apply_rlimits(self.process.pid, {resource.RLIMIT_NOFILE: (64, 64)})
+
+
+class CgroupsTest(unittest.TestCase):
+    """Cgroups on a plain directory standing in for the cgroup filesystem."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, "taskmaster")
+        self.cgroups = Cgroups(self.root)
+        self.program = Program(cmd="sleep 1", cpu_max="50000 100000", memory_max=1 << 20)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def read(self, *path):
+        with open(os.path.join(self.root, *path)) as f:
+            return f.read()
+
+    def test_setup(self):
+        self.cgroups.setup("web", self.program)
+        self.assertEqual(self.read("cgroup.subtree_control"), Cgroups.CONTROLLERS)
+        self.assertEqual(self.read("web", "cpu.max"), "50000 100000\n")
+        self.assertEqual(self.read("web", "memory.max"), f"{1 << 20}\n")
+
+    def test_setup_writes_changed_limits_only(self):
+        self.cgroups.setup("web", self.program)
+        os.remove(os.path.join(self.root, "web", "cpu.max"))
+        self.cgroups.setup("web", self.program)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "web", "cpu.max")))
+        self.cgroups.setup("web", Program(cmd="sleep 1", memory_max=1 << 20))
+        self.assertEqual(self.read("web", "cpu.max"), "max\n")
+
+    def test_place_and_flush(self):
+        async def place():
+            self.cgroups.place("web", self.program, 10)
+            self.cgroups.place("web", self.program, 11)
+            self.cgroups.place("db", self.program, 12)
+            self.assertFalse(os.path.exists(os.path.join(self.root, "web", "cgroup.procs")))
+            # Flushed on the next loop iteration.
+            await asyncio.sleep(0)
+
+        asyncio.run(place())
+        self.assertEqual(self.read("web", "cgroup.procs"), "10\n11\n")
+        self.assertEqual(self.read("db", "cgroup.procs"), "12\n")
+        self.assertEqual(self.cgroups.pending, {})
+
+    def test_place_without_limits_or_root(self):
+        async def place():
+            self.cgroups.place("web", Program(cmd="sleep 1"), 10)
+            Cgroups().place("web", self.program, 10)
+
+        asyncio.run(place())
+        self.assertFalse(os.path.exists(self.root))
+
+    def test_flush_of_missing_cgroup(self):
+        self.cgroups.pending = {"web": [10]}
+        self.cgroups.root = os.path.join(self.tmp.name, "missing")
+        self.cgroups.flush()
+        self.assertEqual(self.cgroups.pending, {})
+
+    def test_configure_new_root(self):
+        self.cgroups.setup("web", self.program)
+        self.cgroups.configure(os.path.join(self.tmp.name, "other"))
+        self.assertEqual(self.cgroups.configured, {})
+        self.cgroups.setup("web", self.program)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, "other", "web", "memory.max")))
+
+
+if __name__ == "__main__":
+    unittest.main()